@@ -1,9 +1,14 @@
 __all__ = [
+    'bench',
     'channel',
     'cli',
+    'client',
     'context',
     'filter',
     'functions',
+    'memo',
     'parser',
+    'profiler',
+    'tracer',
     'values'
 ]
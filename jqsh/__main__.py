@@ -3,47 +3,208 @@
 """A shell based on jq.
 
 Usage:
-  jqsh [<module_file> [<arguments>...]]
-  jqsh -c <filter> | --filter=<filter> [<arguments>...]
+  jqsh [options] [--input=<file>... [--interleave]] [<module_file> [<arguments>...]]
+  jqsh [options] [--input=<file>... [--interleave]] -c <filter> | --filter=<filter> [<arguments>...]
+  jqsh [options] [--input=<file>... [--interleave]] (-c <filter> | --filter=<filter>)... [--output=<file>...] [<arguments>...]
+  jqsh [options] --jobs=<n> [--unordered] [--input=<file>...] -c <filter> | --filter=<filter> [<arguments>...]
+  jqsh [options] --serve=<socket>
+  jqsh [options] --connect=<socket> [--input=<file>...] -c <filter> | --filter=<filter> [<arguments>...]
   jqsh -h | --help
 
 Options:
   -c, --filter=<filter>  Apply this filter to the standard input instead of starting interactive mode.
+                         May be repeated, in which case the input is decoded once and passed to each filter. Unless --output is given,
+                         the outputs are then printed as [index, value] pairs, where index is the position of the filter, starting at 0.
+  --connect=<socket>     Run the filter on a server started with --serve instead of in this process, streaming the input to it.
+                         The server formats the output, so it is not syntax highlighted.
+  --compact              Print each value on one line, without spaces or syntax highlighting (NDJSON).
+  --debug-channels       Remember the filter node that created each channel. After running, print the channels that were never terminated
+                         to the standard error, with the filters that created them. In interactive mode, the :metrics command prints them.
+  --coprocesses=<n>      Keep up to n long-lived processes for each command line instead of starting a process for every evaluation of a command.
+                         Each input value is written to a process as one line of JSON, and the process must answer with its output values followed by an empty line.
+  --explain              Print the filter tree instead of running it, with an estimate of the threads and channel splits each node starts
+                         on each run, whether it buffers values, and whether the filter can be run with --jobs.
   -h, --help             Print this message and exit.
+  --input=<file>         Read the input values from this file instead of the standard input. The file is memory-mapped, not read into memory.
+                         May be a glob pattern and may be repeated, in which case the files are decoded one after the other.
+  --interleave           With multiple input files, decode each file in its own thread and pass on values as soon as any file has produced them
+                         instead of in file order.
+  --memoize=<n>          Cache the outputs of the filters that are run once for each input value, such as the bodies of each and reduce,
+                         keeping the n most recently used results. Only filters without commands and variables are cached.
+                         After running, the numbers of cache hits and misses are printed to the standard error. In interactive mode, the :metrics command prints them.
+  --jobs=<n>             Split the NDJSON input into chunks of lines and run the filter on each chunk separately, in n worker processes.
+                         Only use this with filters that handle each input value on its own. The output is not syntax highlighted.
+  --output=<file>        Write the output to this file instead of the standard output.
+                         With multiple filters, give this once for each filter, in the same order.
+  --profile              After running, print the filter tree to the standard error, with the following for each node: wall-clock time,
+                         number of runs, values read and written, threads started, and time spent waiting for input.
+                         Pipes and loops run every node in its own thread while profiling, so that each one is counted.
+  --raw-output           Print strings without quotes and escaping.
+  --trace=<file>         Record the threads and channel operations of the filters and write them to this file in the Trace Event Format,
+                         which can be opened in chrome://tracing or Perfetto (https://ui.perfetto.dev).
+  --serve=<socket>       Keep running and run filters for clients using --connect on this Unix socket, each in its own thread.
+                         Parsed filters are kept across requests.
+  --unordered            With --jobs, print the output of each chunk as soon as it is ready instead of in input order.
+  --sort-keys            Print object keys in sorted order. This is the default.
+  --no-sort-keys         Print object keys in insertion order, which saves sorting every printed object.
 """
 
 import sys
 
 sys.path.append('/opt/py')
 
-import jqsh.channel
-import jqsh.context
-import jqsh.cli
-import jqsh.filter
-import jqsh.parser
-import json
-import pathlib
-
 arguments = sys.argv[1:]
 
-filter_argument = None
+compact = False
+connect_socket = None
+coprocess_pool_size = None
+debug_channels = False
+explain = False
+filter_arguments = []
+input_paths = []
+interleave = False
+jobs = None
+memo_size = None
 module = None
+output_paths = []
 parse_options = True
+profile = False
+raw_output = False
+serve_socket = None
+sort_keys = True
+trace_path = None
+unordered = False
 
 while len(arguments):
     if parse_options and (arguments[0].startswith('-c') or arguments[0].startswith('--filter=') or arguments[0] == '--filter'):
         if arguments[0] == '-c' and len(arguments) > 1:
-            filter_argument = arguments[1]
+            filter_arguments.append(arguments[1])
             arguments = arguments[2:]
         elif arguments[0].startswith('-c'):
-            filter_argument = arguments[0][len('-c'):]
+            filter_arguments.append(arguments[0][len('-c'):])
             arguments.pop(0)
         elif arguments[0].startswith('--filter='):
-            filter_argument = arguments[0][len('--filter='):]
+            filter_arguments.append(arguments[0][len('--filter='):])
             arguments.pop(0)
         elif arguments[0] == '--filter':
-            filter_argument = arguments[1]
+            filter_arguments.append(arguments[1])
+            arguments = arguments[2:]
+    elif parse_options and (arguments[0].startswith('--input=') or arguments[0] == '--input'):
+        if arguments[0] == '--input' and len(arguments) > 1:
+            input_path = arguments[1]
+            arguments = arguments[2:]
+        elif arguments[0].startswith('--input='):
+            input_path = arguments[0][len('--input='):]
+            arguments.pop(0)
+        else:
+            sys.exit('[!!!!] jqsh: missing argument for --input')
+        import glob
+        
+        matching_paths = sorted(glob.glob(input_path, recursive=True))
+        if len(matching_paths) == 0:
+            sys.exit('[!!!!] jqsh: no input file matches ' + input_path)
+        input_paths += matching_paths
+    elif parse_options and (arguments[0].startswith('--output=') or arguments[0] == '--output'):
+        if arguments[0] == '--output' and len(arguments) > 1:
+            output_paths.append(arguments[1])
             arguments = arguments[2:]
+        elif arguments[0].startswith('--output='):
+            output_paths.append(arguments[0][len('--output='):])
+            arguments.pop(0)
+        else:
+            sys.exit('[!!!!] jqsh: missing argument for --output')
+    elif parse_options and (arguments[0].startswith('--jobs=') or arguments[0] == '--jobs'):
+        if arguments[0] == '--jobs' and len(arguments) > 1:
+            jobs_argument = arguments[1]
+            arguments = arguments[2:]
+        elif arguments[0].startswith('--jobs='):
+            jobs_argument = arguments[0][len('--jobs='):]
+            arguments.pop(0)
+        else:
+            sys.exit('[!!!!] jqsh: missing argument for --jobs')
+        try:
+            jobs = int(jobs_argument)
+        except ValueError:
+            sys.exit('[!!!!] jqsh: invalid number of jobs: ' + jobs_argument)
+        if jobs < 1:
+            sys.exit('[!!!!] jqsh: invalid number of jobs: ' + jobs_argument)
+    elif parse_options and arguments[0] == '--unordered':
+        unordered = True
+        arguments.pop(0)
+    elif parse_options and arguments[0] == '--interleave':
+        interleave = True
+        arguments.pop(0)
+    elif parse_options and arguments[0] == '--explain':
+        explain = True
+        arguments.pop(0)
+    elif parse_options and arguments[0] == '--debug-channels':
+        debug_channels = True
+        arguments.pop(0)
+    elif parse_options and arguments[0] == '--profile':
+        profile = True
+        arguments.pop(0)
+    elif parse_options and (arguments[0].startswith('--trace=') or arguments[0] == '--trace'):
+        if arguments[0] == '--trace' and len(arguments) > 1:
+            trace_path = arguments[1]
+            arguments = arguments[2:]
+        elif arguments[0].startswith('--trace='):
+            trace_path = arguments[0][len('--trace='):]
+            arguments.pop(0)
+        else:
+            sys.exit('[!!!!] jqsh: missing argument for --trace')
+    elif parse_options and (arguments[0].startswith('--coprocesses=') or arguments[0] == '--coprocesses'):
+        if arguments[0] == '--coprocesses' and len(arguments) > 1:
+            coprocesses_argument = arguments[1]
+            arguments = arguments[2:]
+        elif arguments[0].startswith('--coprocesses='):
+            coprocesses_argument = arguments[0][len('--coprocesses='):]
+            arguments.pop(0)
+        else:
+            sys.exit('[!!!!] jqsh: missing argument for --coprocesses')
+        try:
+            coprocess_pool_size = int(coprocesses_argument)
+        except ValueError:
+            sys.exit('[!!!!] jqsh: invalid number of coprocesses: ' + coprocesses_argument)
+        if coprocess_pool_size < 1:
+            sys.exit('[!!!!] jqsh: invalid number of coprocesses: ' + coprocesses_argument)
+    elif parse_options and (arguments[0].startswith('--memoize=') or arguments[0] == '--memoize'):
+        if arguments[0] == '--memoize' and len(arguments) > 1:
+            memoize_argument = arguments[1]
+            arguments = arguments[2:]
+        elif arguments[0].startswith('--memoize='):
+            memoize_argument = arguments[0][len('--memoize='):]
+            arguments.pop(0)
+        else:
+            sys.exit('[!!!!] jqsh: missing argument for --memoize')
+        try:
+            memo_size = int(memoize_argument)
+        except ValueError:
+            sys.exit('[!!!!] jqsh: invalid cache size: ' + memoize_argument)
+        if memo_size < 1:
+            sys.exit('[!!!!] jqsh: invalid cache size: ' + memoize_argument)
+    elif parse_options and (arguments[0].startswith('--connect=') or arguments[0] == '--connect' or arguments[0].startswith('--serve=') or arguments[0] == '--serve'):
+        option = arguments[0].split('=', 1)[0]
+        if '=' in arguments[0]:
+            socket_path = arguments[0][len(option + '='):]
+            arguments.pop(0)
+        elif len(arguments) > 1:
+            socket_path = arguments[1]
+            arguments = arguments[2:]
+        else:
+            sys.exit('[!!!!] jqsh: missing argument for ' + option)
+        if option == '--connect':
+            connect_socket = socket_path
+        else:
+            serve_socket = socket_path
+    elif parse_options and arguments[0] == '--compact':
+        compact = True
+        arguments.pop(0)
+    elif parse_options and arguments[0] == '--raw-output':
+        raw_output = True
+        arguments.pop(0)
+    elif parse_options and arguments[0] in ('--sort-keys', '--no-sort-keys'):
+        sort_keys = arguments[0] == '--sort-keys'
+        arguments.pop(0)
     elif parse_options and (arguments[0] == '--help' or arguments[0].startswith('-h')):
         print('jqsh:', __doc__)
         sys.exit()
@@ -52,38 +213,211 @@ while len(arguments):
         arguments.pop(0)
     elif parse_options and arguments[0].startswith('-') and len(arguments[0]) > 1:
         sys.exit('[!!!!] jqsh: invalid option: ' + arguments[0])
-    elif filter_argument is None and module is None:
+    elif len(filter_arguments) == 0 and module is None:
+        import pathlib
+        
         module = pathlib.Path(arguments[0]) #TODO handle reading from stdin
         arguments.pop(0)
         parse_options = False
     else:
         break
 
-if filter_argument is not None or module is not None:
-    if sys.stdin.isatty():
-        stdin_channel = jqsh.channel.Channel(context=jqsh.context.FilterContext.command_line_context(['--filter' if filter_argument is not None else module] + arguments), terminated=True)
-    else:
-        stdin_channel = jqsh.channel.Channel(*jqsh.parser.parse_json_values(sys.stdin.read()), context=jqsh.context.FilterContext.command_line_context(['--filter' if filter_argument is not None else module] + arguments), terminated=True) #TODO fix: this currently waits to read the entire stdin before even looking at the filter
+if (profile or trace_path is not None or memo_size is not None) and (connect_socket is not None or serve_socket is not None or jobs is not None):
+    sys.exit('[!!!!] jqsh: --profile, --trace and --memoize are not supported with --connect, --serve or --jobs')
+
+if connect_socket is not None:
+    import jqsh.client # the rest of jqsh is not imported, so that the client starts quickly
+    
+    if len(filter_arguments) != 1 or len(output_paths):
+        sys.exit('[!!!!] jqsh: --connect requires exactly one filter and does not support --output')
+    try:
+        input_files = [open(input_path, 'rb') for input_path in input_paths]
+    except OSError as e:
+        sys.exit('[!!!!] jqsh: could not open input file: ' + str(e))
+    if len(input_files) == 0 and not sys.stdin.isatty():
+        input_files = [sys.stdin.buffer]
+    try:
+        jqsh.client.connect(connect_socket, filter_arguments[0], argv=arguments, input_files=input_files, compact=compact, raw_output=raw_output, sort_keys=sort_keys)
+    except SyntaxError as e:
+        sys.exit('[!!!!] jqsh: syntax error in filter: ' + str(e))
+    except OSError as e:
+        sys.exit('[!!!!] jqsh: could not connect to ' + connect_socket + ': ' + str(e))
+    sys.exit()
+
+import jqsh.channel
+import jqsh.context
+import jqsh.cli
+import jqsh.filter
+import jqsh.parser
+
+coprocesses = None if coprocess_pool_size is None else jqsh.filter.CoprocessPool(coprocess_pool_size)
+jqsh.channel.registry.enabled = jqsh.channel.registry.track_creators = debug_channels
+
+def file_values(input_file):
+    """Yields the JSON values in the binary input file, and closes it once they have all been read."""
+    with input_file:
+        yield from jqsh.parser.parse_json_file(input_file)
+
+def print_leaks(filter_threads):
+    """Waits for the filter threads to finish, then prints the channels that are still unterminated to the standard error."""
+    for filter_thread in filter_threads:
+        filter_thread.join()
+    for line in jqsh.channel.registry.leak_report_lines():
+        print('jqsh: ' + line, file=sys.stderr)
+
+def print_profile(filter_threads):
+    """Waits for the filter threads to finish, then prints the profile of each of their filters to the standard error."""
+    for filter_thread in filter_threads:
+        filter_thread.join()
+        for line in filter_thread.profile.profiler.report_lines(filter_thread.filter):
+            print(line, file=sys.stderr)
+
+def write_trace(filter_threads):
+    """Waits for the filter threads to finish, then writes the trace they were recorded with to the --trace file."""
+    for filter_thread in filter_threads:
+        filter_thread.join()
+    try:
+        with open(trace_path, 'w') as trace_file:
+            filter_threads[0].tracer.dump(trace_file)
+    except OSError as e:
+        sys.exit('[!!!!] jqsh: could not write trace file: ' + str(e))
+
+if memo_size is not None:
+    import jqsh.memo
+if profile:
+    import jqsh.profiler
+if trace_path is not None:
+    import jqsh.tracer
+
+if explain:
     if module is None:
+        filter_strings = filter_arguments
+    else:
+        with module.resolve().open() as module_file:
+            filter_strings = [module_file.read()]
+    if len(filter_strings) == 0:
+        sys.exit('[!!!!] jqsh: --explain requires a filter or module')
+    for filter_string in filter_strings:
         try:
-            the_filter = jqsh.parser.parse(filter_argument)
+            the_filter = jqsh.parser.parse(filter_string, line_numbers=module is not None)
         except (SyntaxError, jqsh.parser.Incomplete) as e:
             sys.exit('[!!!!] jqsh: syntax error in filter: ' + str(e))
+        for line in jqsh.cli.explain_lines(the_filter):
+            print(line)
+    sys.exit()
+
+if serve_socket is not None:
+    try:
+        jqsh.cli.serve(serve_socket, coprocesses=coprocesses)
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        sys.exit('[!!!!] jqsh: could not serve on ' + serve_socket + ': ' + str(e))
+    finally:
+        if coprocesses is not None:
+            coprocesses.close()
+    sys.exit()
+
+if jobs is not None:
+    if len(filter_arguments) != 1 or len(output_paths):
+        sys.exit('[!!!!] jqsh: --jobs requires exactly one filter and does not support --output')
+    try:
+        the_filter = jqsh.parser.parse(filter_arguments[0])
+    except (SyntaxError, jqsh.parser.Incomplete) as e:
+        sys.exit('[!!!!] jqsh: syntax error in filter: ' + str(e))
+    try:
+        input_files = [open(input_path, 'rb') for input_path in input_paths] or [sys.stdin.buffer]
+    except OSError as e:
+        sys.exit('[!!!!] jqsh: could not open input file: ' + str(e))
+    jqsh.cli.run_jobs(the_filter, input_files, jobs, argv=['--filter'] + arguments, ordered=not unordered, compact=compact, raw_output=raw_output, sort_keys=sort_keys)
+    sys.exit()
+
+if len(filter_arguments) or module is not None:
+    if len(output_paths) not in (0, max(1, len(filter_arguments))):
+        sys.exit('[!!!!] jqsh: --output must be given once for each filter')
+    if len(input_paths) == 1:
+        try:
+            input_values = file_values(open(input_paths[0], 'rb'))
+        except OSError as e:
+            sys.exit('[!!!!] jqsh: could not open input file: ' + str(e))
+    elif len(input_paths) > 1:
+        input_values = jqsh.cli.decode_json_files(input_paths, interleave=interleave)
+    elif sys.stdin.isatty():
+        input_values = ()
+    else:
+        input_values = jqsh.parser.parse_json_file(sys.stdin.buffer)
+    context = jqsh.context.FilterContext.command_line_context(['--filter' if len(filter_arguments) else module] + arguments)
+    context.coprocesses = coprocesses
+    if memo_size is not None:
+        context.memo = jqsh.memo.Memo(memo_size)
+    stdin_channel = jqsh.cli.input_channel(input_values, context=context)
+    if module is None:
+        filters = []
+        for filter_argument in filter_arguments:
+            try:
+                filters.append(jqsh.parser.parse(filter_argument))
+            except (SyntaxError, jqsh.parser.Incomplete) as e:
+                sys.exit('[!!!!] jqsh: syntax error in filter: ' + str(e))
     else:
         with module.resolve().open() as module_file:
             try:
-                the_filter = jqsh.parser.parse(module_file.read(), line_numbers=True)
+                filters = [jqsh.parser.parse(module_file.read(), line_numbers=True)]
             except (SyntaxError, jqsh.parser.Incomplete) as e:
                 sys.exit('[!!!!] jqsh: syntax error reading module: ' + str(e))
-    jqsh.cli.print_output(jqsh.filter.FilterThread(the_filter, input_channel=stdin_channel)) #TODO fix: this currently waits to read the entire module file before starting to tokenize it
+    profiler = jqsh.profiler.Profiler() if profile else None
+    tracer = None if trace_path is None else jqsh.tracer.Tracer()
+    if len(filters) == 1 and len(output_paths) == 0:
+        filter_threads = [jqsh.filter.FilterThread(filters[0], input_channel=stdin_channel, profiler=profiler, tracer=tracer)]
+        jqsh.cli.print_output(filter_threads[0], compact=compact, raw_output=raw_output, sort_keys=sort_keys) #TODO fix: this currently waits to read the entire module file before starting to tokenize it
+    else:
+        try:
+            output_files = [open(output_path, 'w', encoding='utf-8') for output_path in output_paths]
+        except OSError as e:
+            sys.exit('[!!!!] jqsh: could not open output file: ' + str(e))
+        input_channels = stdin_channel / len(filters) if len(filters) > 1 else (stdin_channel,)
+        filter_threads = [jqsh.filter.FilterThread(the_filter, input_channel=filter_input, profiler=profiler, tracer=tracer) for the_filter, filter_input in zip(filters, input_channels)]
+        jqsh.cli.print_outputs(filter_threads, output_files=output_files or None, compact=compact, raw_output=raw_output, sort_keys=sort_keys)
+        for output_file in output_files:
+            output_file.close()
+    if profile:
+        print_profile(filter_threads)
+    if trace_path is not None:
+        write_trace(filter_threads)
+    if debug_channels:
+        print_leaks(filter_threads)
+    if context.memo is not None:
+        for filter_thread in filter_threads:
+            filter_thread.join()
+        print('jqsh: memo: ' + context.memo.report_line(), file=sys.stderr)
+    if coprocesses is not None:
+        coprocesses.close()
     sys.exit()
 
+jqsh.channel.registry.enabled = True # for the :metrics command
+context = jqsh.context.FilterContext()
+context.coprocesses = coprocesses
+if memo_size is not None:
+    context.memo = jqsh.memo.Memo(memo_size)
 global_namespace = {}
 local_namespace = {}
 format_strings = {}
 while True: # a simple repl
     try:
-        global_namespace, local_namespace, format_strings = jqsh.cli.print_output(jqsh.filter.FilterThread(jqsh.parser.parse(input('jqsh> ')), input_channel=jqsh.channel.Channel(global_namespace=global_namespace, local_namespace=local_namespace, format_strings=format_strings, terminated=True)))
+        filter_string = input('jqsh> ')
+        if filter_string.strip() == ':metrics':
+            for name, count in sorted(jqsh.channel.registry.metrics().items()):
+                print(name.replace('_', ' ') + ':', count)
+            if debug_channels:
+                print_leaks([])
+            if context.memo is not None:
+                print('memo: ' + context.memo.report_line())
+            continue
+        filter_thread = jqsh.filter.FilterThread(jqsh.parser.parse(filter_string), input_channel=jqsh.channel.Channel(global_namespace=global_namespace, local_namespace=local_namespace, format_strings=format_strings, context=context, terminated=True), profiler=jqsh.profiler.Profiler() if profile else None, tracer=None if trace_path is None else jqsh.tracer.Tracer())
+        global_namespace, local_namespace, format_strings = jqsh.cli.print_output(filter_thread, compact=compact, raw_output=raw_output, sort_keys=sort_keys)
+        if profile:
+            print_profile([filter_thread])
+        if trace_path is not None:
+            write_trace([filter_thread])
     except EOFError:
         print('^D')
         break
@@ -92,3 +426,7 @@ while True: # a simple repl
         continue
     except (SyntaxError, jqsh.parser.Incomplete) as e:
         print('jqsh: syntax error: ' + str(e))
+if context.memo is not None:
+    print('jqsh: memo: ' + context.memo.report_line(), file=sys.stderr)
+if coprocesses is not None:
+    coprocesses.close()
@@ -0,0 +1,251 @@
+"""Benchmarks for jqsh.
+
+Run with python3 -m jqsh.bench, which prints the results as JSON so they can be compared between revisions. All input data is generated from fixed seeds, so every revision is measured on the same data.
+Times are the best of several runs. Keys of the results that end in _seconds are times, which compare uses to compute speedups.
+"""
+
+import sys
+
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import threading
+import time
+
+def best_time(function, repeat=5):
+    """Calls the function repeat times and returns the shortest wall-clock time in seconds."""
+    ret = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start_time
+        if ret is None or elapsed < ret:
+            ret = elapsed
+    return ret
+
+def builtins(repeat=5):
+    """Runs filters that spend their time in the range, nth and reduce builtins."""
+    filters = {
+        'fibonacci': '30 | range | reduce (0, 1) (nth 1, nth 0 + nth 1) | nth 0', # the body of $fib in examples/fibonacci.jqsh
+        'nth': '2000 | range | nth 1000',
+        'range': '2000 | range',
+        'reduce': '200 | range | reduce 0 (. + 1)'
+    }
+    return {name + '_seconds': best_time(lambda: run_filter(filter_string), repeat=repeat) for name, filter_string in filters.items()}
+
+def channel_fanout(repeat=5, num_values=5000, num_channels=4):
+    """Splits a channel with Channel.__truediv__ and reads all values from each of the split channels."""
+    import jqsh.channel
+    import jqsh.values
+
+    def fan_out():
+        channel = jqsh.channel.Channel(*values, terminated=True)
+        for split_channel in channel / num_channels:
+            for _ in split_channel:
+                pass
+
+    values = [jqsh.values.Number(i) for i in range(num_values)]
+    seconds = best_time(fan_out, repeat=repeat)
+    return {
+        'channels': num_channels,
+        'seconds': seconds,
+        'values': num_values,
+        'values_per_second': num_values * num_channels / seconds
+    }
+
+def channel_throughput(repeat=5, num_values=20000):
+    """Pushes values onto a channel from one thread while popping them in another."""
+    import jqsh.channel
+    import jqsh.values
+
+    def push_values(channel):
+        for value in values:
+            channel.push(value)
+        channel.terminate()
+
+    def push_and_pop():
+        channel = jqsh.channel.Channel()
+        producer = threading.Thread(target=push_values, args=(channel,))
+        producer.start()
+        for _ in channel:
+            pass
+        producer.join()
+
+    values = [jqsh.values.Number(i) for i in range(num_values)]
+    seconds = best_time(push_and_pop, repeat=repeat)
+    return {
+        'seconds': seconds,
+        'values': num_values,
+        'values_per_second': num_values / seconds
+    }
+
+def cli_ndjson(repeat=5, num_records=2000):
+    """Runs jqsh from the command line on a generated NDJSON file, from interpreter startup to the last line of output."""
+    with tempfile.NamedTemporaryFile('w', suffix='.ndjson', encoding='utf-8') as input_file:
+        for record in generated_records(num_records):
+            input_file.write(json.dumps(record) + '\n')
+        input_file.flush()
+        environment = jqsh_environment()
+        command = jqsh_command('--compact', '--input=' + input_file.name, '-c', '."name"')
+        seconds = best_time(lambda: subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, env=environment, check=True), repeat=repeat)
+    return {
+        'records': num_records,
+        'records_per_second': num_records / seconds,
+        'seconds': seconds
+    }
+
+def compare(old_results, new_results):
+    """Yields a line for each time in both results of run_benchmarks, with the old and new time and the speedup."""
+    for benchmark_name in sorted(set(old_results['benchmarks']) & set(new_results['benchmarks'])):
+        old_benchmark = old_results['benchmarks'][benchmark_name]
+        new_benchmark = new_results['benchmarks'][benchmark_name]
+        for key in sorted(set(old_benchmark) & set(new_benchmark)):
+            if key.endswith('_seconds') or key == 'seconds':
+                old_time, new_time = old_benchmark[key], new_benchmark[key]
+                if isinstance(old_time, (int, float)) and isinstance(new_time, (int, float)) and new_time > 0:
+                    yield '{}.{}: {:.6f}s -> {:.6f}s ({:.2f}x)'.format(benchmark_name, key, old_time, new_time, old_time / new_time)
+
+def examples(repeat=5):
+    """Parses and runs each of the example modules on empty input. Modules that cannot be parsed or run are reported with the exception class."""
+    import jqsh.parser
+
+    examples_path = os.path.join(package_parent(), 'examples')
+    ret = {}
+    for example_name in ('arrays', 'fibonacci'):
+        with open(os.path.join(examples_path, example_name + '.jqsh'), encoding='utf-8') as module_file:
+            module_string = module_file.read()
+        try:
+            ret[example_name + '_seconds'] = best_time(lambda: run_filter(jqsh.parser.parse(module_string, line_numbers=True), argv=[example_name + '.jqsh', '20']), repeat=repeat)
+        except Exception as e:
+            ret[example_name + '_error'] = e.__class__.__name__
+    return ret
+
+def generated_json(num_records=2000):
+    """Returns a JSON array of generated records, as a string."""
+    return json.dumps(generated_records(num_records), indent=2)
+
+def generated_module(num_statements=500):
+    """Returns a jqsh module with the given number of global variable assignments, as a string."""
+    return ';\n'.join('$value = [{0}, "s{0}", {{"key": (. + {0}) * 2, "list": [true, false, null]}}] | nth 0 | . + 1'.format(i) for i in range(num_statements))
+
+def generated_records(num_records):
+    """Returns a list of JSON-serializable records with strings, integers, nested objects and arrays, the same for every call."""
+    generator = random.Random(0)
+    return [
+        {
+            'id': i,
+            'name': ''.join(generator.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(generator.randrange(4, 16))),
+            'score': generator.randrange(1000000), # the tokenizer only supports integers
+            'tags': [generator.choice(['a', 'b', 'c', 'd\n', 'é']) for _ in range(generator.randrange(4))],
+            'user': {'active': generator.random() < 0.5, 'email': None}
+        }
+        for i in range(num_records)
+    ]
+
+def jqsh_command(*args, importtime=False):
+    """Returns the command line for running jqsh with the arguments, using the same interpreter and package as this module."""
+    return [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-m', 'jqsh'] + list(args)
+
+def jqsh_environment():
+    """Returns the environment for jqsh subprocesses, with this package first on the module search path."""
+    ret = dict(os.environ)
+    ret['PYTHONPATH'] = package_parent() + (os.pathsep + ret['PYTHONPATH'] if ret.get('PYTHONPATH') else '')
+    return ret
+
+def package_parent():
+    """Returns the directory that contains the jqsh package."""
+    return os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def parse_module(repeat=5, num_statements=500):
+    """Tokenizes and parses a large generated module."""
+    import jqsh.parser
+
+    module_string = generated_module(num_statements)
+    return {
+        'characters': len(module_string),
+        'seconds': best_time(lambda: jqsh.parser.parse(module_string, line_numbers=True), repeat=repeat)
+    }
+
+def run_benchmarks(names=None, repeat=5):
+    """Runs the named benchmarks, or all of them, and returns their results along with a description of the environment."""
+    if names is None:
+        names = sorted(benchmarks)
+    return {
+        'benchmarks': {name: benchmarks[name](repeat=repeat) for name in names},
+        'environment': {
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'python': platform.python_version(),
+            'revision': revision()
+        }
+    }
+
+def run_filter(the_filter, input_values=(), argv=()):
+    """Runs a filter, given as a string or parsed, on the input values and returns its output, formatted as it would be printed to a file."""
+    import jqsh.cli
+    import jqsh.context
+    import jqsh.filter
+    import jqsh.parser
+
+    if isinstance(the_filter, str):
+        the_filter = jqsh.parser.parse(the_filter)
+    output_file = io.StringIO()
+    jqsh.cli.print_output(jqsh.filter.FilterThread(the_filter, input_channel=jqsh.cli.input_channel(input_values, context=jqsh.context.FilterContext.command_line_context(argv))), output_file=output_file)
+    return output_file.getvalue()
+
+def revision():
+    """Returns the git commit of the source tree the benchmarks are run from, or None if it is not a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=package_parent(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def startup(repeat=10):
+    """Measures the startup cost of running a trivial filter on empty input.
+
+    Wall-clock times are the best of repeat runs, next to the time for starting the interpreter alone. Import times are the cumulative times reported by python -X importtime for the top-level modules.
+    """
+    environment = jqsh_environment()
+    import_times = {}
+    importtime_output = subprocess.run(jqsh_command('-c', '.', importtime=True), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=environment, universal_newlines=True, check=True).stderr
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or line.count('|') != 2:
+            continue
+        _, cumulative, module_name = line.split('|')
+        if not cumulative.strip().isdigit() or module_name.startswith('  '): # header or nested import
+            continue
+        import_times[module_name.strip()] = int(cumulative)
+    return {
+        'import_microseconds': import_times,
+        'import_microseconds_total': sum(import_times.values()),
+        'interpreter_seconds': best_time(lambda: subprocess.run([sys.executable, '-c', 'pass'], env=environment, check=True), repeat=repeat),
+        'jqsh_seconds': best_time(lambda: subprocess.run(jqsh_command('-c', '.'), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, env=environment, check=True), repeat=repeat)
+    }
+
+def tokenize_json(repeat=5, num_records=2000):
+    """Tokenizes and decodes a large generated JSON document, both as a string and as bytes."""
+    import jqsh.parser
+
+    json_string = generated_json(num_records)
+    json_bytes = json_string.encode('utf-8')
+    return {
+        'bytes': len(json_bytes),
+        'decode_bytes_seconds': best_time(lambda: list(jqsh.parser.parse_json_bytes(json_bytes)), repeat=repeat),
+        'tokenize_bytes_seconds': best_time(lambda: list(jqsh.parser.tokenize_json_bytes(json_bytes)), repeat=repeat),
+        'tokenize_seconds': best_time(lambda: list(jqsh.parser.tokenize(json_string)), repeat=repeat)
+    }
+
+benchmarks = {
+    'builtins': builtins,
+    'channel_fanout': channel_fanout,
+    'channel_throughput': channel_throughput,
+    'cli_ndjson': cli_ndjson,
+    'examples': examples,
+    'parse_module': parse_module,
+    'startup': startup,
+    'tokenize_json': tokenize_json
+}
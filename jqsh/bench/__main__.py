@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+"""Run the jqsh benchmarks.
+
+Usage:
+  python3 -m jqsh.bench [options] [<benchmark>...]
+  python3 -m jqsh.bench -h | --help
+
+Options:
+  --compare=<file>  Compare the results to earlier results saved from this command, printing the speedup for each time to the standard error.
+  -h, --help        Print this message and exit.
+  --repeat=<n>      Run each timed step this many times and report the best time [default: 5].
+"""
+
+import sys
+
+import jqsh.bench
+import json
+
+arguments = sys.argv[1:]
+
+compare_path = None
+names = []
+repeat = 5
+
+while len(arguments):
+    if arguments[0].startswith('--compare='):
+        compare_path = arguments[0][len('--compare='):]
+        arguments = arguments[1:]
+    elif arguments[0] == '--compare':
+        compare_path = arguments[1]
+        arguments = arguments[2:]
+    elif arguments[0] in ('-h', '--help'):
+        print(__doc__.strip())
+        sys.exit()
+    elif arguments[0].startswith('--repeat='):
+        repeat = int(arguments[0][len('--repeat='):])
+        arguments = arguments[1:]
+    elif arguments[0] == '--repeat':
+        repeat = int(arguments[1])
+        arguments = arguments[2:]
+    elif arguments[0].startswith('-'):
+        sys.exit('[!!!!] jqsh.bench: unknown option: ' + arguments[0])
+    else:
+        names.append(arguments[0])
+        arguments = arguments[1:]
+
+unknown_names = [name for name in names if name not in jqsh.bench.benchmarks]
+if len(unknown_names):
+    sys.exit('[!!!!] jqsh.bench: no such benchmark: ' + ', '.join(unknown_names))
+results = jqsh.bench.run_benchmarks(names or None, repeat=repeat)
+json.dump(results, sys.stdout, indent=4, sort_keys=True)
+print()
+if compare_path is not None:
+    with open(compare_path) as compare_file:
+        for line in jqsh.bench.compare(json.load(compare_file), results):
+            print(line, file=sys.stderr)
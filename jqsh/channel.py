@@ -1,8 +1,14 @@
+import collections
+import collections.abc
 import contextlib
 import functools
 import jqsh.context
 import queue
 import threading
+import time
+import weakref
+
+tracing = False # set once a jqsh.tracer.Tracer is created, see Channel.__init__
 
 class Terminator:
     """a special value used to signal the end of a channel"""
@@ -16,17 +22,32 @@ def coerce_other(f):
     
     return wrapper
 
+def instrumented():
+    """Returns whether the current thread is profiled or traced. Pipes and loops then run fusable filters in their own filter threads, so that each node is counted by the profiler and recorded by the tracer."""
+    current_thread = threading.current_thread()
+    return getattr(current_thread, 'profile', None) is not None or getattr(current_thread, 'tracer', None) is not None
+
 class Channel:
     _globals = None
     _locals = None
     _format_strings = None
     _context = None
     input_terminated = False # has the terminator been pushed?
+    profile_reader = None # the jqsh.profiler.NodeProfile of the filter reading this channel as its input, if profiling
+    profile_writer = None # the jqsh.profiler.NodeProfile of the filter writing its output to this channel, if profiling
     terminated = False # has the terminator been popped?
+    tracer = None # the jqsh.tracer.Tracer recording operations on this channel, if tracing
     
     def __init__(self, *args, global_namespace=None, local_namespace=None, format_strings=None, terminated=False, empty_namespaces=None, context=None):
         self.input_lock = threading.Lock()
         self.output_lock = threading.Lock()
+        if tracing or registry.enabled: # channels, including array and object values, are created often, so this is skipped unless needed
+            creator = threading.current_thread()
+            tracer = getattr(creator, 'tracer', None)
+            if tracer is not None:
+                self.tracer = tracer
+            if registry.enabled:
+                registry.register(self, creator)
         # namespaces and context
         if empty_namespaces is None:
             empty_namespaces = terminated
@@ -82,6 +103,7 @@ class Channel:
                         chan.terminate()
                     break
                 self.store_value(value)
+                self.count_value()
                 for chan in split_channels:
                     chan.push(value)
         
@@ -100,15 +122,25 @@ class Channel:
                 if isinstance(value, Terminator):
                     break
                 self.store_value(value)
+                self.count_value()
                 buffered_values.append(value)
         ret = [Channel(*buffered_values) for _ in range(other)]
-        threading.Thread(target=spread_values, args=(ret,)).start()
-        threading.Thread(target=self.push_namespaces, args=tuple(ret)).start()
+        if self.tracer is not None:
+            self.tracer.instant('split', 'channel', channel=id(self), channels=[id(chan) for chan in ret])
+        Thread(target=spread_values, args=(ret,)).start()
+        Thread(target=self.push_namespaces, args=tuple(ret)).start()
         return tuple(ret)
     
+    def count_value(self):
+        """Records a value read from this channel with the profiles of its reader and writer, if any."""
+        if self.profile_reader is not None:
+            self.profile_reader.add(values_in=1)
+        if self.profile_writer is not None:
+            self.profile_writer.add(values_out=1)
+    
     @property
     def global_namespace(self):
-        self.has_globals.wait()
+        self.wait_for(self.has_globals, 'global_namespace')
         return self._globals
     
     @global_namespace.setter
@@ -118,7 +150,7 @@ class Channel:
     
     @property
     def local_namespace(self):
-        self.has_locals.wait()
+        self.wait_for(self.has_locals, 'local_namespace')
         return self._locals
     
     @local_namespace.setter
@@ -128,7 +160,7 @@ class Channel:
     
     @property
     def format_strings(self):
-        self.has_format_strings.wait()
+        self.wait_for(self.has_format_strings, 'format_strings')
         return self._format_strings
     
     @format_strings.setter
@@ -138,7 +170,7 @@ class Channel:
     
     @property
     def context(self):
-        self.has_context.wait()
+        self.wait_for(self.has_context, 'context')
         return self._context
     
     @context.setter
@@ -152,16 +184,27 @@ class Channel:
     def namespaces(self):
         return self.global_namespace, self.local_namespace, self.format_strings
     
-    def pop(self, wait=True):
-        """Returns a value. Raises queue.Empty if no element is currently available, and StopIteration if the channel is terminated."""
+    def pop(self, wait=True, timeout=None):
+        """Returns a value. Raises queue.Empty if no element is currently available (or none becomes available within the timeout), and StopIteration if the channel is terminated."""
         with self.output_lock:
             if self.terminated:
                 raise StopIteration('jqsh channel has terminated')
-            ret = self.value_queue.get(block=wait)
+            if self.profile_reader is None and self.tracer is None:
+                ret = self.value_queue.get(block=wait, timeout=timeout)
+            else:
+                start_time = time.perf_counter()
+                try:
+                    ret = self.value_queue.get(block=wait, timeout=timeout)
+                finally:
+                    if self.profile_reader is not None:
+                        self.profile_reader.add(blocked_seconds=time.perf_counter() - start_time)
+                    if self.tracer is not None:
+                        self.tracer.complete('pop', 'channel', start_time, channel=id(self))
             if isinstance(ret, Terminator):
                 self.terminated = True
                 raise StopIteration('jqsh channel has terminated')
             self.store_value(ret)
+            self.count_value()
         return ret
     
     def pull(self, from_channel, terminate=True):
@@ -179,8 +222,12 @@ class Channel:
             except StopIteration:
                 break
             self.value_queue.put(value)
+            if self.tracer is not None:
+                self.tracer.instant('push', 'channel', channel=id(self))
         if terminate:
             self.value_queue.put(Terminator())
+            if self.tracer is not None:
+                self.tracer.instant('terminate', 'channel', channel=id(self))
         else:
             self.input_lock.release()
     
@@ -190,6 +237,8 @@ class Channel:
             if self.input_terminated:
                 raise RuntimeError('jqsh channel has terminated')
             self.value_queue.put(value)
+        if self.tracer is not None:
+            self.tracer.instant('push', 'channel', channel=id(self))
     
     def push_attribute(self, attribute_name, *output_channels):
         """Waits until the attribute is available, then passes it unchanged to the output channels. Used by Filter.run_raw and Channel.push_namespaces."""
@@ -200,7 +249,7 @@ class Channel:
     def push_namespaces(self, *output_channels, include_context=True):
         threads = []
         for attribute_name in ['global_namespace', 'local_namespace', 'format_strings'] + (['context'] if include_context else []):
-            thread = threading.Thread(target=self.push_attribute, args=(attribute_name,) + output_channels)
+            thread = Thread(target=self.push_attribute, args=(attribute_name,) + output_channels)
             thread.start()
             threads.append(thread)
         for thread in threads:
@@ -213,6 +262,8 @@ class Channel:
         with self.input_lock:
             self.input_terminated = True
             self.value_queue.put(Terminator())
+        if self.tracer is not None:
+            self.tracer.instant('terminate', 'channel', channel=id(self))
     
     def throw(self, exception):
         """Tries to append the exception onto the channel, failing silently if terminated, then defines all properties for which events are defined, and terminates."""
@@ -231,3 +282,163 @@ class Channel:
         if self._context is None:
             self.context = jqsh.context.FilterContext()
         self.terminate()
+    
+    def wait_for(self, event, attribute_name):
+        """Waits until the event for the attribute is set. While tracing, the time spent waiting is recorded."""
+        if self.tracer is None or event.is_set():
+            event.wait()
+        else:
+            start_time = time.perf_counter()
+            event.wait()
+            self.tracer.complete('wait ' + attribute_name, 'namespace', start_time, channel=id(self))
+
+class Namespace(collections.abc.Mapping):
+    """A namespace of variables that extends a parent namespace, which may be any mapping.
+    
+    Assigning a variable creates a namespace with only that variable, whose parent is the previous namespace, so it takes constant time however many variables are defined, and the previous namespace is not changed. Looking up a variable walks the chain of parents.
+    Parents whose variables are all shadowed are skipped, and once the chain is longer than max_depth, it is merged into a single namespace without the shadowed variables, so that reassigning variables, e.g. in interactive mode, does not keep the old values alive.
+    """
+    max_depth = 32
+    
+    def __init__(self, variables=None, parent=None):
+        if variables is None:
+            variables = {}
+        while isinstance(parent, Namespace) and parent.variables.keys() <= variables.keys():
+            parent = parent.parent
+        self.depth = parent.depth + 1 if isinstance(parent, Namespace) else 1
+        if self.depth > self.max_depth:
+            merged_variables = {}
+            while isinstance(parent, Namespace):
+                for name, value in parent.variables.items():
+                    merged_variables.setdefault(name, value) # namespaces closer to this one shadow their parents
+                parent = parent.parent
+            merged_variables.update(variables)
+            variables = merged_variables
+            self.depth = 1
+        self.parent = parent
+        self.variables = variables
+    
+    def __getitem__(self, name):
+        namespace = self
+        while isinstance(namespace, Namespace):
+            if name in namespace.variables:
+                return namespace.variables[name]
+            namespace = namespace.parent
+        if namespace is None:
+            raise KeyError(name)
+        return namespace[name]
+    
+    def __iter__(self):
+        seen = set()
+        namespace = self
+        while namespace is not None:
+            for name in (namespace.variables if isinstance(namespace, Namespace) else namespace):
+                if name not in seen:
+                    seen.add(name)
+                    yield name
+            namespace = namespace.parent if isinstance(namespace, Namespace) else None
+    
+    def __len__(self):
+        return sum(1 for _ in self)
+
+class ReplayBuffer:
+    """The values of a variable. They are read from the channel of the assigned filter as they are needed, and kept so that each iteration replays all of them. Reads of the variable can start before the assigned filter has finished."""
+    def __init__(self, value_channel):
+        self.lock = threading.Lock()
+        self.terminated = False
+        self.value_channel = value_channel
+        self.values = []
+    
+    def __iter__(self):
+        index = 0
+        while True:
+            if index >= len(self.values):
+                with self.lock: # only one thread reads from the channel, the others wait for its value
+                    if index >= len(self.values):
+                        if self.terminated:
+                            return
+                        try:
+                            self.values.append(self.value_channel.pop())
+                        except StopIteration:
+                            self.terminated = True
+                            return
+            yield self.values[index]
+            index += 1
+
+class Registry:
+    """Keeps track of all live channels, including array and object values, to find leaked channels and threads.
+    
+    Channels are held weakly, so the registry does not keep them alive. Only channels created while enabled is set are registered, so that creating a channel does not take the lock otherwise. If track_creators is set, each channel created afterwards remembers the filter node whose thread created it, which is shown in the leak report.
+    """
+    def __init__(self):
+        self.channels = weakref.WeakValueDictionary() # keyed by id, since values are channels with their own equality
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.track_creators = False
+    
+    def leak_report_lines(self):
+        """Yields a line for each filter node that created channels which are still unterminated, with the number of such channels and the values buffered in them."""
+        import gc
+        
+        gc.collect() # collect channels that are only kept alive by reference cycles
+        leaks = collections.OrderedDict()
+        for chan in self.unterminated_channels():
+            if not hasattr(chan, 'created_by'):
+                creator = '(unknown, created while track_creators was not set)'
+            elif chan.created_by is None:
+                creator = '(no filter)'
+            else:
+                creator = str(chan.created_by) or repr(chan.created_by)
+            num_channels, num_values = leaks.get(creator, (0, 0))
+            leaks[creator] = num_channels + 1, num_values + chan.value_queue.qsize()
+        for creator, (num_channels, num_values) in leaks.items():
+            yield '{} unterminated channel{} with {} buffered value{}, created by: {}'.format(num_channels, '' if num_channels == 1 else 's', num_values, '' if num_values == 1 else 's', creator)
+    
+    def live_channels(self):
+        with self.lock:
+            return list(self.channels.values())
+    
+    def metrics(self):
+        """Returns a dictionary with the numbers of live channels, values buffered in their queues, live jqsh threads, and live channels that have not been terminated."""
+        channels = self.live_channels()
+        return {
+            'buffered_values': sum(chan.value_queue.qsize() for chan in channels),
+            'live_channels': len(channels),
+            'live_threads': sum(1 for thread in threading.enumerate() if isinstance(thread, Thread)),
+            'unterminated_channels': sum(1 for chan in channels if not chan.input_terminated)
+        }
+    
+    def register(self, chan, creator):
+        if self.track_creators:
+            chan.created_by = getattr(creator, 'filter', None)
+        with self.lock:
+            self.channels[id(chan)] = chan
+    
+    def unterminated_channels(self):
+        return [chan for chan in self.live_channels() if not chan.input_terminated]
+
+class Thread(threading.Thread):
+    """A thread started by jqsh to run part of a filter.
+    
+    The thread belongs to the filter node of the thread that created it. While profiling, it is counted in that node's profile, and while tracing, its lifetime is recorded under the node's name.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        creator = threading.current_thread()
+        self.filter = getattr(creator, 'filter', None)
+        self.profile = getattr(creator, 'profile', None)
+        self.tracer = getattr(creator, 'tracer', None)
+        if self.profile is not None:
+            self.profile.add(threads=1)
+    
+    def run(self):
+        if self.tracer is None:
+            super().run()
+        else:
+            start_time = time.perf_counter()
+            try:
+                super().run()
+            finally:
+                self.tracer.complete('thread', 'thread', start_time)
+
+registry = Registry()
@@ -1,17 +1,357 @@
 import sys
 
-import blessings
+import collections
+import functools
+import io
+import jqsh.channel
+import jqsh.context
 import jqsh.filter
 import jqsh.parser
 import jqsh.values
+import itertools
+import os
+import queue
+import threading
+import time
 
-def print_output(filter_thread, output_file=None):
-    terminal = blessings.Terminal()
-    if output_file is None:
-        output_file = sys.stdout
+job_options = None # the filter, argv and output options of run_jobs worker processes, set by init_jobs
+
+class OutputWriter:
+    """Writes values to a file or pipe, without syntax highlighting or any other terminal handling.
+    
+    Serialized values are collected and written in a single call, once buffer_size characters are buffered, once the oldest buffered value has waited for flush_interval seconds, or at the end of the output.
+    The compact and sort_keys options are passed to jqsh.values.serialize. With raw_output=True, strings are written as they are, without quotes and escaping.
+    """
+    def __init__(self, output_file, buffer_size=65536, flush_interval=0.1, compact=False, raw_output=False, sort_keys=True):
+        self.buffer = []
+        self.buffer_size = buffer_size
+        self.buffered_since = None
+        self.buffered_size = 0
+        self.compact = compact
+        self.flush_interval = flush_interval
+        self.output_file = output_file
+        self.raw_output = raw_output
+        self.sort_keys = sort_keys
+    
+    def flush(self):
+        if len(self.buffer):
+            self.output_file.write(''.join(self.buffer))
+            self.buffer = []
+            self.buffered_since = None
+            self.buffered_size = 0
+        self.output_file.flush()
+    
+    def write(self, value):
+        if self.buffered_since is None:
+            self.buffered_since = time.monotonic()
+        if self.raw_output and isinstance(value, jqsh.values.String):
+            chunks = [value.value, '\n']
+        else:
+            chunks = itertools.chain(jqsh.values.serialize(value, compact=self.compact, sort_keys=self.sort_keys), ['\n'])
+        for chunk in chunks:
+            self.buffer.append(chunk)
+            self.buffered_size += len(chunk)
+            if self.buffered_size >= self.buffer_size:
+                self.flush()
+                self.buffered_since = time.monotonic()
+        if time.monotonic() - self.buffered_since >= self.flush_interval:
+            self.flush()
+    
+    def write_channel(self, channel):
+        """Writes all values from the channel, then flushes. While waiting for values, buffered output is flushed when it is due."""
+        while True:
+            try:
+                if self.buffered_since is None:
+                    value = channel.pop()
+                else:
+                    value = channel.pop(timeout=max(0, self.buffered_since + self.flush_interval - time.monotonic()))
+            except queue.Empty:
+                self.flush()
+                continue
+            except StopIteration:
+                break
+            self.write(value)
+        self.flush()
+
+@functools.lru_cache(maxsize=256)
+def compiled_filter(filter_string):
+    """Parses a filter. The most recently used filters are kept, so that the server does not parse the same filter again for every request. Filters do not change while they run, so a cached filter can run for several requests at once."""
+    return jqsh.parser.parse(filter_string)
+
+def decode_json_files(paths, interleave=False):
+    """Decodes the JSON files and returns an iterator over their values, in file order.
+    
+    With interleave=True, each file is decoded in its own thread and values are yielded as soon as any file has produced them, e.g. for input files that are pipes. Errors opening or decoding a file are raised from the iterator as SyntaxError, with the path of the file.
+    """
+    def decode_file(path):
+        try:
+            with open(path, 'rb') as json_file:
+                for value in jqsh.parser.parse_json_file(json_file):
+                    decoded_values.put((value, None))
+        except (OSError, SyntaxError, jqsh.parser.Incomplete) as e:
+            decoded_values.put((None, SyntaxError(str(path) + ': ' + str(e))))
+        else:
+            decoded_values.put((None, None)) # marks the end of the file
+    
+    def interleaved_values():
+        finished_files = 0
+        while finished_files < len(paths):
+            value, error = decoded_values.get()
+            if error is not None:
+                raise error
+            if value is None:
+                finished_files += 1
+            else:
+                yield value
+    
+    def ordered_values():
+        for path in paths:
+            try:
+                with open(path, 'rb') as json_file:
+                    yield from jqsh.parser.parse_json_file(json_file)
+            except (OSError, SyntaxError, jqsh.parser.Incomplete) as e:
+                raise SyntaxError(str(path) + ': ' + str(e)) from e
+    
+    if not interleave:
+        return ordered_values()
+    decoded_values = queue.Queue(maxsize=1024) # bounded, so that a fast file does not get decoded far ahead of the filter
+    for path in paths:
+        threading.Thread(target=decode_file, args=(path,), name='jqsh input ' + str(path), daemon=True).start()
+    return interleaved_values()
+
+def explain_lines(the_filter, max_width=80):
+    """Yields the lines of a table with the estimate from Filter.explain for each node in the tree of the filter, followed by a summary. Nodes that are not run are shown without estimates."""
+    yield ' '.join(['threads', 'splits', 'parallel', 'filter'])
+    total_threads = total_splits = per_value_threads = 0
+    buffering_nodes = 0
+    nodes = [(the_filter, 0, False, True, False)]
+    while len(nodes):
+        node, depth, per_value, started, fused = nodes.pop()
+        node_string = '  ' * depth + (str(node) or repr(node))
+        if len(node_string) > max_width:
+            node_string = node_string[:max_width - 3] + '...'
+        if not started:
+            yield '{:>7} {:>6} {:8} {}'.format('-', '-', '', node_string)
+            continue
+        plan = node.explain()
+        if fused:
+            yield '{:7d} {:6d} {:8} {}'.format(0, 0, 'yes' if plan['parallel'] else 'no', node_string) + '  # runs in the thread of a pipe'
+            nodes += reversed([(child, depth + 1, per_value, child not in plan['not_started'], True) for child in node.children() if child.__class__ != jqsh.filter.Filter])
+            continue
+        if per_value:
+            per_value_threads += plan['threads']
+        else:
+            total_threads += plan['threads']
+            total_splits += plan['splits']
+        if plan['buffers'] is not None:
+            buffering_nodes += 1
+        notes = []
+        if plan['buffers'] is not None:
+            notes.append('buffers ' + plan['buffers'])
+        if len(plan['per_value']):
+            notes.append('starts ' + ', '.join(str(child) for child in plan['per_value']) + ' for each input value')
+        yield '{:7d} {:6d} {:8} {}'.format(plan['threads'], plan['splits'], 'yes' if plan['parallel'] else 'no', node_string) + ('  # ' + '; '.join(notes) if len(notes) else '')
+        nodes += reversed([(child, depth + 1, per_value or child in plan['per_value'], child not in plan['not_started'], child in plan['fused']) for child in node.children() if child.__class__ != jqsh.filter.Filter]) # empty filters are not run
+    yield '{} threads and {} channel splits{}, {} buffering node{}, {}'.format(
+        total_threads,
+        total_splits,
+        '' if per_value_threads == 0 else ', plus {} threads for each input value'.format(per_value_threads),
+        buffering_nodes,
+        '' if buffering_nodes == 1 else 's',
+        'can be run with --jobs' if the_filter.explain()['parallel'] else 'cannot be run with --jobs'
+    )
+
+def init_jobs(the_filter, argv, compact, raw_output, sort_keys):
+    global job_options
+    
+    job_options = the_filter, argv, compact, raw_output, sort_keys
+
+def input_channel(values, context=None):
+    """Returns a channel with empty namespaces that is fed the values by a background thread, so that filters can start before the whole input is decoded."""
+    def push_values():
+        try:
+            for value in values:
+                ret.push(value)
+        except (SyntaxError, UnicodeDecodeError, jqsh.parser.Incomplete) as e:
+            ret.throw(jqsh.values.JQSHException('inputSyntax', python_exception=e))
+        except OSError as e:
+            ret.throw(jqsh.values.JQSHException('input', python_exception=e))
+        except Exception as e:
+            import traceback
+            
+            ret.throw(jqsh.values.JQSHException('internal', python_exception=e, exc_info=sys.exc_info(), traceback_string=traceback.format_exc()))
+        finally:
+            if not ret.input_terminated: # terminate even after other errors, so that the filter does not wait for more input forever
+                ret.terminate()
+    
+    ret = jqsh.channel.Channel(empty_namespaces=True, context=context)
+    threading.Thread(target=push_values, name='jqsh input', daemon=True).start()
+    return ret
+
+def ndjson_chunks(input_files, chunk_size=1048576):
+    """Reads the binary input files and yields their contents in chunks of roughly chunk_size bytes that end at line boundaries, so that with NDJSON input, no value is split between chunks."""
+    for input_file in input_files:
+        rest = b''
+        while True:
+            data = input_file.read(chunk_size)
+            if not data:
+                break
+            end = data.rfind(b'\n') + 1
+            if end == 0: # no line ends yet, keep reading
+                rest += data
+                continue
+            yield rest + data[:end]
+            rest = data[end:]
+        if rest.strip():
+            yield rest
+
+def print_output(filter_thread, output_file=None, compact=False, raw_output=False, sort_keys=True):
+    """Runs the filter and prints its output with write_output."""
     if isinstance(filter_thread, jqsh.filter.Filter):
         filter_thread = jqsh.filter.FilterThread(filter_thread)
     filter_thread.start()
-    for value in filter_thread.output_channel:
-        value.print_to_terminal(terminal, output_file)
+    write_output(filter_thread.output_channel, output_file=output_file, compact=compact, raw_output=raw_output, sort_keys=sort_keys)
     return filter_thread.output_channel.namespaces()
+
+def print_outputs(filter_threads, output_files=None, compact=False, raw_output=False, sort_keys=True):
+    """Runs several filters at once and prints their outputs with write_output.
+    
+    With output_files, the output of each filter is written to the file at the same index. Otherwise, the outputs are printed to the standard output as [index, value] pairs, in the order in which the values are produced.
+    """
+    def tag_values(index, channel):
+        for value in channel:
+            tagged_values.push(jqsh.values.Array([jqsh.values.Number(index), value]))
+    
+    def terminate_tagged_values():
+        for tag_thread in tag_threads:
+            tag_thread.join()
+        tagged_values.terminate()
+    
+    for filter_thread in filter_threads:
+        filter_thread.start()
+    if output_files is None:
+        tagged_values = jqsh.channel.Channel()
+        tag_threads = [threading.Thread(target=tag_values, args=(index, filter_thread.output_channel), name='jqsh output ' + str(index)) for index, filter_thread in enumerate(filter_threads)]
+        for tag_thread in tag_threads:
+            tag_thread.start()
+        threading.Thread(target=terminate_tagged_values, name='jqsh output').start()
+        write_output(tagged_values, compact=compact, raw_output=raw_output, sort_keys=sort_keys)
+    else:
+        write_threads = [threading.Thread(target=write_output, args=(filter_thread.output_channel, output_file), kwargs={'compact': compact, 'raw_output': raw_output, 'sort_keys': sort_keys}, name='jqsh output ' + str(index)) for index, (filter_thread, output_file) in enumerate(zip(filter_threads, output_files))]
+        for write_thread in write_threads:
+            write_thread.start()
+        for write_thread in write_threads:
+            write_thread.join()
+
+def run_job(chunk):
+    """Runs in a worker process of run_jobs. Runs the filter on the values in the chunk and returns its formatted output."""
+    the_filter, argv, compact, raw_output, sort_keys = job_options
+    output_file = io.StringIO()
+    print_output(jqsh.filter.FilterThread(the_filter, input_channel=input_channel(jqsh.parser.parse_json_bytes(chunk), context=jqsh.context.FilterContext.command_line_context(argv))), output_file=output_file, compact=compact, raw_output=raw_output, sort_keys=sort_keys)
+    return output_file.getvalue()
+
+def run_jobs(the_filter, input_files, jobs, argv=(), ordered=True, chunk_size=1048576, output_file=None, compact=False, raw_output=False, sort_keys=True):
+    """Runs the filter separately on chunks of NDJSON input in jobs worker processes and writes the combined output.
+    
+    This gives the same output as running the filter once on the whole input only if the filter handles each input value on its own. The input is split at line boundaries by ndjson_chunks.
+    By default, the outputs are written in input order. With ordered=False, each chunk's output is written as soon as it is ready. At most twice as many chunks as there are jobs are held in memory at a time.
+    This should be called before any other threads are started, since it forks the worker processes.
+    """
+    import multiprocessing
+    
+    def write_next_output():
+        if ordered:
+            output = pending_jobs.popleft().get()
+        else:
+            pending_jobs.pop()
+            output = finished_jobs.get()
+            if isinstance(output, Exception):
+                raise output
+        output_file.write(output)
+    
+    if output_file is None:
+        output_file = sys.stdout
+    multiprocessing_context = multiprocessing.get_context('fork') # the filter is passed to the workers by forking, since filters cannot be pickled
+    finished_jobs = queue.Queue() # output or exceptions of finished jobs, only used if not ordered
+    pending_jobs = collections.deque() # results of submitted jobs, in input order
+    pool = multiprocessing_context.Pool(jobs, initializer=init_jobs, initargs=(the_filter, list(argv), compact, raw_output, sort_keys))
+    try:
+        for chunk in ndjson_chunks(input_files, chunk_size=chunk_size):
+            if len(pending_jobs) >= 2 * jobs:
+                write_next_output()
+            if ordered:
+                pending_jobs.append(pool.apply_async(run_job, (chunk,)))
+            else:
+                pending_jobs.append(pool.apply_async(run_job, (chunk,), callback=finished_jobs.put, error_callback=finished_jobs.put))
+        while len(pending_jobs):
+            write_next_output()
+        output_file.flush()
+    finally:
+        pool.terminate()
+
+def serve(socket_path, coprocesses=None):
+    """Runs filters for clients using jqsh.client.connect on a Unix socket, until interrupted.
+    
+    The protocol is described in jqsh.client. Each request is handled in its own thread and runs with its own FilterContext, which shares the coprocesses pool if one is given. Parsed filters are cached across requests by compiled_filter.
+    """
+    import json
+    import socket
+    import socketserver
+    import stat
+    
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                request_line = self.rfile.readline()
+                if not request_line:
+                    return # e.g. another server checking whether this one is running
+                try:
+                    request = json.loads(request_line.decode('utf-8'))
+                except ValueError:
+                    return # not a jqsh client
+                try:
+                    the_filter = compiled_filter(request['filter'])
+                except (SyntaxError, jqsh.parser.Incomplete) as e:
+                    self.wfile.write(json.dumps({'error': str(e)}).encode('utf-8') + b'\n')
+                    return
+                self.wfile.write(b'{}\n')
+                context = jqsh.context.FilterContext.command_line_context(['--filter'] + request['argv'])
+                context.coprocesses = coprocesses
+                output_file = io.TextIOWrapper(self.wfile, encoding='utf-8', write_through=True)
+                try:
+                    print_output(jqsh.filter.FilterThread(the_filter, input_channel=input_channel(jqsh.parser.parse_json_lines(self.rfile), context=context)), output_file=output_file, compact=request['compact'], raw_output=request['raw_output'], sort_keys=request['sort_keys'])
+                finally:
+                    output_file.detach() # the socket is closed by the request handler
+            except (BrokenPipeError, ConnectionResetError):
+                pass # the client has gone away
+    
+    if os.path.exists(socket_path):
+        if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            raise FileExistsError('not a socket: ' + socket_path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(socket_path)
+            except ConnectionRefusedError:
+                os.remove(socket_path) # left behind by a server that did not shut down cleanly
+            else:
+                raise OSError('a jqsh server is already running on ' + socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, RequestHandler)
+    server.daemon_threads = True
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+def write_output(channel, output_file=None, compact=False, raw_output=False, sort_keys=True):
+    """Prints the values from the channel. Values are syntax highlighted if the output file is a terminal and neither compact nor raw output is requested."""
+    if output_file is None:
+        output_file = sys.stdout
+    if output_file.isatty() and not compact and not raw_output:
+        import blessings
+        
+        terminal = blessings.Terminal()
+        for value in channel:
+            value.print_to_terminal(terminal, output_file, sort_keys=sort_keys)
+    else:
+        OutputWriter(output_file, compact=compact, raw_output=raw_output, sort_keys=sort_keys).write_channel(channel)
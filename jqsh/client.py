@@ -0,0 +1,57 @@
+"""The client for jqsh servers started with jqsh.cli.serve.
+
+This module does not import the rest of jqsh, so that a client starts quickly. The client sends a request line, a JSON object with the filter, its arguments and the output options, followed by the input.
+The server answers with a status line, a JSON object that has an "error" key if the filter could not be parsed, followed by the output.
+"""
+
+import sys
+
+import json
+import os
+import socket
+import threading
+
+def connect(socket_path, filter_string, argv=(), input_files=(), output_file=None, compact=False, raw_output=False, sort_keys=True):
+    """Runs a filter on a server started with jqsh.cli.serve.
+    
+    The contents of the input files, which must have file descriptors, are streamed to the server while the output is written to the binary output_file. The output options are applied by the server. Raises SyntaxError if the server could not parse the filter.
+    """
+    def send_input():
+        try:
+            for input_file in input_files:
+                while True:
+                    chunk = os.read(input_file.fileno(), 65536) # returns as soon as any input is available, so piped input is passed on as it arrives, and holds no lock that would keep the interpreter from exiting while it waits
+                    if not chunk:
+                        break
+                    connection.sendall(chunk)
+                connection.sendall(b'\n') # keep the last value of one file apart from the first value of the next
+            connection.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass # the server has closed the connection
+    
+    if output_file is None:
+        output_file = sys.stdout.buffer
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        request = {
+            'argv': list(argv),
+            'compact': compact,
+            'filter': filter_string,
+            'raw_output': raw_output,
+            'sort_keys': sort_keys
+        }
+        connection.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        threading.Thread(target=send_input, name='jqsh client input', daemon=True).start()
+        with connection.makefile('rb') as response:
+            status_line = response.readline()
+            if not status_line:
+                raise ConnectionError('the jqsh server closed the connection')
+            status = json.loads(status_line.decode('utf-8'))
+            if status.get('error') is not None:
+                raise SyntaxError(status['error'])
+            while True:
+                chunk = response.read1(65536)
+                if not chunk:
+                    break
+                output_file.write(chunk)
+                output_file.flush()
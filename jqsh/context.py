@@ -1,24 +1,32 @@
+import copy
+
 class FilterContext:
+    """The settings filters are run with. A default context is created for every terminated channel, so the defaults are class attributes and creating one does no work."""
+    argv = ()
+    coprocesses = None # a jqsh.filter.CoprocessPool to run commands in, or None to start a new process for each evaluation of a command
+    is_main = True
+    linked_builtins = True # whether filters may call the builtins resolved when they were created, see jqsh.filter.Apply.link_builtin; set this to False in subclasses that override get_builtin
+    memo = None # a jqsh.memo.Memo to cache the outputs of pure filters that are run once for each input value, or None to always run them
+    
     def __copy__(self):
         ret = FilterContext()
         ret.argv = self.argv[:]
+        ret.coprocesses = self.coprocesses
         ret.is_main = self.is_main
+        ret.memo = self.memo
         return ret
     
-    def __init__(self):
-        """Creates the default context."""
-        import jqsh.functions
-        
-        self.argv = []
-        self.get_builtin = jqsh.functions.get_builtin
-        self.is_main = True
-    
     @classmethod
     def command_line_context(cls, argv):
         ret = cls()
         ret.argv = list(argv)
         return ret
     
+    def get_builtin(self, name, *args, num_args=None):
+        import jqsh.functions
+        
+        return jqsh.functions.get_builtin(name, *args, num_args=num_args)
+    
     def imported(self):
         """Returns a copy of self with is_main set to False."""
         ret = copy.copy(self)
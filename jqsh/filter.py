@@ -7,23 +7,128 @@ import itertools
 import jqsh.channel
 import jqsh.functions
 import jqsh.values
-import more_itertools
-import subprocess
+import queue
 import threading
-import traceback
+import time
 
 class NotAllowed(Exception):
     pass
 
-class FilterThread(threading.Thread):
-    def __init__(self, the_filter, input_channel=None):
-        super().__init__(name='jqsh FilterThread')
+class CoprocessPool:
+    """Keeps long-lived child processes for commands, so that evaluating a command does not start a new process every time.
+    
+    Up to size processes are started for each command line, and each input value is sent to whichever of them is idle. The processes speak a line protocol: each input value is written as one line of compact JSON, and the process answers with any number of JSON values followed by an empty line.
+    """
+    def __init__(self, size=1):
+        self.lock = threading.Lock()
+        self.size = size
+        self.slots = {} # maps command lines to queues of idle processes, with None for each process that has not been started yet
+    
+    def acquire(self, command_line):
+        """Returns an idle process for the command line, starting one if the pool is not yet full. Otherwise, blocks until a process is released."""
+        import subprocess
+        
+        with self.lock:
+            if command_line not in self.slots:
+                self.slots[command_line] = queue.Queue()
+                for _ in range(self.size):
+                    self.slots[command_line].put(None)
+            slots = self.slots[command_line]
+        popen = slots.get()
+        if popen is None:
+            try:
+                popen = subprocess.Popen(command_line, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            except OSError:
+                slots.put(None)
+                raise
+        return popen
+    
+    def close(self):
+        """Closes the input of all idle processes and waits for them to exit."""
+        with self.lock:
+            slots = list(self.slots.values())
+        for command_slots in slots:
+            while not command_slots.empty():
+                popen = command_slots.get()
+                if popen is not None:
+                    with contextlib.suppress(BrokenPipeError):
+                        popen.stdin.close()
+                    popen.wait()
+    
+    def release(self, command_line, popen, reusable=True):
+        """Returns a process to the pool. A process that is not reusable, e.g. because it broke the protocol, is killed and replaced the next time it is needed."""
+        if not reusable:
+            popen.kill()
+            popen.wait()
+            popen = None
+        self.slots[command_line].put(popen)
+    
+    def run(self, command_line, value):
+        """Yields the values a process for the command line outputs for one input value."""
+        import jqsh.parser
+        
+        try:
+            popen = self.acquire(command_line)
+        except FileNotFoundError:
+            yield jqsh.values.JQSHException('path')
+            return
+        except PermissionError:
+            yield jqsh.values.JQSHException('permission')
+            return
+        output_lines = []
+        reusable = False
+        try:
+            for chunk in jqsh.values.serialize_bytes(value, compact=True):
+                popen.stdin.write(chunk)
+            popen.stdin.write(b'\n')
+            popen.stdin.flush()
+            for line in popen.stdout:
+                if line.strip() == b'':
+                    reusable = True
+                    break
+                output_lines.append(line)
+        except BrokenPipeError:
+            pass
+        finally:
+            self.release(command_line, popen, reusable=reusable)
+        if not reusable: # the process exited before finishing its answer
+            yield jqsh.values.JQSHException('commandOutput')
+            return
+        try:
+            yield from jqsh.parser.parse_json_lines(output_lines)
+        except (UnicodeDecodeError, SyntaxError, jqsh.parser.Incomplete):
+            yield jqsh.values.JQSHException('commandOutput')
+
+class FilterThread(jqsh.channel.Thread):
+    def __init__(self, the_filter, input_channel=None, profiler=None, tracer=None):
+        """Creates a thread that runs the filter on the input channel.
+        
+        If a jqsh.profiler.Profiler is given, or the thread is created by a profiled filter thread, the filter and all filters started by it are profiled. The same goes for a jqsh.tracer.Tracer and tracing.
+        """
+        super().__init__(name='jqsh FilterThread', target=self.run_filter)
         self.filter = the_filter
+        if tracer is not None:
+            self.tracer = tracer
         self.input_channel = jqsh.channel.Channel(terminated=True) if input_channel is None else input_channel
         self.output_channel = jqsh.channel.Channel()
+        if self.tracer is not None:
+            self.input_channel.tracer = self.output_channel.tracer = self.tracer
+        if profiler is None and self.profile is not None:
+            profiler = self.profile.profiler
+        if profiler is not None:
+            self.profile = profiler.node_profile(the_filter)
+            self.input_channel.profile_reader = self.profile
+            self.output_channel.profile_writer = self.profile
     
-    def run(self):
-        self.filter.run_raw(self.input_channel, self.output_channel)
+    def run_filter(self):
+        if self.profile is None:
+            self.filter.run_raw(self.input_channel, self.output_channel)
+        else:
+            start_time = time.perf_counter()
+            try:
+                self.filter.run_raw(self.input_channel, self.output_channel)
+            finally:
+                self.profile.add(runs=1, wall_seconds=time.perf_counter() - start_time)
 
 class Filter:
     """Filters are the basic building block of the jqsh language. This base class implements the empty filter."""
@@ -37,6 +142,39 @@ class Filter:
     def assign(self, value_channel, input_channel, output_channel):
         raise NotImplementedError('cannot assign to this filter')
     
+    def children(self):
+        """Returns the filters this filter is built from, in the order they appear in its string representation."""
+        return ()
+    
+    def explain(self):
+        """Returns an estimate of the work done by one run of this node, not counting the filters it is built from, as a dictionary:
+        
+        threads: the number of threads started, including the filter thread
+        splits: the number of channel splits, each of which starts 6 more threads (included in threads)
+        buffers: None if values are passed on as they arrive, otherwise a description of what is kept in memory
+        fused: the filters this filter is built from that run in its thread as generators, see fusable
+        not_started: the filters this filter is built from that are not run, such as the names of functions
+        parallel: whether splitting the input, running the whole filter on each part, and concatenating the outputs gives the same output, so that --jobs can be used
+        per_value: the filters this filter is built from that are started once for each input value
+        """
+        return {
+            'buffers': None,
+            'fused': (),
+            'not_started': (),
+            'parallel': True, # the empty filter produces no output
+            'per_value': (),
+            'splits': 0,
+            'threads': 7 # the filter thread, the run_thread helper, and push_namespaces with a thread for each of the 4 namespaces
+        }
+    
+    def fusable(self):
+        """Returns whether run_fused can be used instead of run_raw. Fusable filters handle each input value as it arrives, don't change the namespaces, and don't need threads of their own, so a pipe runs them in its thread."""
+        return self.__class__ == Filter
+    
+    def pure(self):
+        """Returns whether the outputs of this filter only depend on its input values, so that they can be cached by a jqsh.memo.Memo. By default, a filter is pure if the filters it is built from are."""
+        return all(child.pure() for child in self.children())
+    
     def run(self, input_channel):
         """This is called from run_raw, and should be overridden by subclasses.
         
@@ -45,6 +183,13 @@ class Filter:
         return
         yield # the empty generator #FROM http://stackoverflow.com/a/13243870/667338
     
+    def run_fused(self, values, input_channel):
+        """This is called from stream if fusable returns True. Like run, but the input values are read from an iterator without exceptions, and input_channel is only used for the namespaces and context."""
+        for value in values:
+            pass # read the input, so the filters before this one run to completion
+        return
+        yield
+    
     def run_raw(self, input_channel, output_channel):
         """This is called from the filter thread, and may be overridden by subclasses instead of run."""
         def run_thread(bridge):
@@ -54,11 +199,13 @@ class Filter:
                     if isinstance(value, jqsh.values.JQSHException):
                         break
             except Exception as e:
+                import traceback
+                
                 output_channel.throw(jqsh.values.JQSHException('internal', python_exception=e, exc_info=sys.exc_info(), traceback_string=traceback.format_exc()))
         
         bridge_channel = jqsh.channel.Channel()
-        helper_thread = threading.Thread(target=run_thread, kwargs={'bridge': bridge_channel})
-        handle_namespaces = threading.Thread(target=input_channel.push_namespaces, args=(bridge_channel, output_channel))
+        helper_thread = jqsh.channel.Thread(target=run_thread, kwargs={'bridge': bridge_channel})
+        handle_namespaces = jqsh.channel.Thread(target=input_channel.push_namespaces, args=(bridge_channel, output_channel))
         helper_thread.start()
         handle_namespaces.start()
         for value in input_channel:
@@ -82,6 +229,31 @@ class Filter:
         filter_thread = FilterThread(self, input_channel=input_channel)
         filter_thread.start()
         return filter_thread.output_channel
+    
+    def stream(self, values, input_channel):
+        """Runs the fusable filter on an iterator of input values in the calling thread, and yields its outputs.
+        
+        Exceptions are handled like in run_raw: an exception in the input is yielded after the outputs for the values before it, and an exception in the output ends it.
+        """
+        exception = None
+        def input_values():
+            nonlocal exception
+            for value in values:
+                if isinstance(value, jqsh.values.JQSHException):
+                    exception = value
+                    return
+                yield value
+        
+        guarded_values = input_values()
+        for value in self.run_fused(guarded_values, input_channel):
+            value = jqsh.values.from_native(value)
+            yield value
+            if isinstance(value, jqsh.values.JQSHException):
+                return
+        for value in guarded_values:
+            pass # read the rest of the input, like run_raw, to find an exception in it
+        if exception is not None:
+            yield exception
 
 class Parens(Filter):
     def __init__(self, attribute=Filter()):
@@ -93,13 +265,32 @@ class Parens(Filter):
     def __str__(self):
         return '(' + str(self.attribute) + ')'
     
+    def children(self):
+        return self.attribute,
+    
+    def explain(self):
+        ret = super().explain()
+        ret['parallel'] = self.attribute.explain()['parallel']
+        return ret
+    
+    def fusable(self):
+        return self.__class__ == Parens and self.attribute.fusable() # arrays and objects collect their values
+    
     def run(self, input_channel):
         yield from self.attribute.start(input_channel)
+    
+    def run_fused(self, values, input_channel):
+        yield from self.attribute.run_fused(values, input_channel)
 
 class Array(Parens):
     def __str__(self):
         return '[' + str(self.attribute) + ']'
     
+    def explain(self):
+        ret = super().explain()
+        ret['parallel'] = False # all values go into one array
+        return ret
+    
     def run(self, input_channel):
         yield jqsh.values.Array(self.attribute.start(input_channel))
 
@@ -107,6 +298,12 @@ class Object(Parens):
     def __str__(self):
         return '{' + str(self.attribute) + '}'
     
+    def explain(self):
+        ret = super().explain()
+        ret['buffers'] = 'all pairs, until the object is complete'
+        ret['parallel'] = False
+        return ret
+    
     def run(self, input_channel):
         #TODO handle shorthand keys and sensible strings
         obj = jqsh.values.Object(terminated=False)
@@ -130,6 +327,16 @@ class Conditional(Filter):
     def __str__(self):
         return ' '.join(attribute_name + ' ' + str(attribute_value) for attribute_name, attribute_value in self.attributes) + ' end'
     
+    def children(self):
+        return tuple(attribute_value for attribute_name, attribute_value in self.attributes)
+    
+    def explain(self):
+        ret = super().explain()
+        ret['parallel'] = False # each condition is evaluated once, for the whole input
+        ret['splits'] = sum(1 for attribute_name, attribute_value in self.attributes if attribute_name in ('if', 'elif', 'elseIf'))
+        ret['threads'] += 6 * ret['splits']
+        return ret
+    
     def run(self, input_channel):
         for attribute_name, attribute_value in self.attributes:
             if attribute_name in ('if', 'elif', 'elseIf'):
@@ -155,6 +362,14 @@ class Conditional(Filter):
                 raise NotImplementedError('unknown clause in if filter')
 
 class Try(Conditional):
+    def explain(self):
+        ret = Filter.explain(self)
+        ret['buffers'] = 'the input, until the try block has finished'
+        ret['parallel'] = False
+        ret['splits'] = sum(1 for attribute_name, attribute_value in self.attributes if attribute_name == 'catch') + 2
+        ret['threads'] += 6 * ret['splits']
+        return ret
+    
     def run(self, input_channel):
         exception_handlers = {}
         default_handler = None
@@ -198,6 +413,10 @@ class Try(Conditional):
 class Name(Filter):
     def __init__(self, name):
         self.name = name
+        try:
+            self.builtin = jqsh.functions.get_builtin(name)
+        except KeyError:
+            self.builtin = None
     
     def __repr__(self):
         return 'jqsh.filter.' + self.__class__.__name__ + '(' + repr(self.name) + ')'
@@ -206,37 +425,55 @@ class Name(Filter):
         return self.name
     
     def assign(self, value_channel, input_channel, output_channel):
-        handle_globals = threading.Thread(target=input_channel.push_attribute, args=('global_namespace', output_channel))
-        handle_format_strings = threading.Thread(target=input_channel.push_attribute, args=('format_strings', output_channel))
-        handle_context = threading.Thread(target=input_channel.push_attribute, args=('context', output_channel))
-        handle_values = threading.Thread(target=output_channel.pull, args=(input_channel,))
+        handle_globals = jqsh.channel.Thread(target=input_channel.push_attribute, args=('global_namespace', output_channel))
+        handle_format_strings = jqsh.channel.Thread(target=input_channel.push_attribute, args=('format_strings', output_channel))
+        handle_context = jqsh.channel.Thread(target=input_channel.push_attribute, args=('context', output_channel))
+        handle_values = jqsh.channel.Thread(target=output_channel.pull, args=(input_channel,))
         handle_globals.start()
         handle_format_strings.start()
         handle_context.start()
         handle_values.start()
-        input_locals = copy.copy(input_channel.local_namespace)
-        var = list(value_channel)
-        for value in var:
-            if isinstance(value, jqsh.values.JQSHException):
-                output_channel.throw(value)
-                break
-        else:
-            input_locals[self.name] = var
-        output_channel.local_namespace = input_locals
-        output_channel.terminate()
+        output_channel.local_namespace = jqsh.channel.Namespace({self.name: jqsh.channel.ReplayBuffer(value_channel)}, parent=input_channel.local_namespace) # pull terminates the output channel
         handle_globals.join()
         handle_format_strings.join()
         handle_context.join()
         handle_values.join()
     
+    def explain(self):
+        ret = super().explain()
+        ret['parallel'] = self.name in jqsh.functions.parallel_builtins # a local variable is output once for the whole input
+        return ret
+    
+    def fusable(self):
+        return self.name in jqsh.functions.fusable_builtins
+    
+    def pure(self):
+        return self.name in jqsh.functions.pure_builtins # a local variable depends on the namespace
+    
+    def run_fused(self, values, input_channel):
+        if self.name in input_channel.local_namespace:
+            yield from input_channel.local_namespace[self.name]
+            return
+        if self.builtin is not None and input_channel.context.linked_builtins:
+            yield from map(jqsh.values.from_native, self.builtin.generator(input_channel=values)) # builtins may yield Python objects, which run_raw converts when pushing them
+            return
+        try:
+            builtin = input_channel.context.get_builtin(self.name)
+        except KeyError:
+            yield jqsh.values.JQSHException('numArgs', function_name=self.name, expected=set(jqsh.functions.builtin_functions[self.name]), received=0) if self.name in jqsh.functions.builtin_functions else jqsh.values.JQSHException('name', missing_name=self.name) # the same exception as from run_raw
+        else:
+            yield from map(jqsh.values.from_native, builtin.generator(input_channel=values))
+    
     def run_raw(self, input_channel, output_channel):
         if self.name in input_channel.local_namespace:
-            handle_namespaces = threading.Thread(target=input_channel.push_namespaces, args=(output_channel,))
+            handle_namespaces = jqsh.channel.Thread(target=input_channel.push_namespaces, args=(output_channel,))
             handle_namespaces.start()
             for value in input_channel.local_namespace[self.name]:
                 output_channel.push(value)
             output_channel.terminate()
             handle_namespaces.join()
+        elif self.builtin is not None and input_channel.context.linked_builtins: # resolved when the filter was created
+            self.builtin(input_channel=input_channel, output_channel=output_channel)
         else:
             try:
                 builtin = input_channel.context.get_builtin(self.name)
@@ -259,8 +496,19 @@ class NumberLiteral(Filter):
     def __str__(self):
         return self.number_string
     
+    def explain(self):
+        ret = super().explain()
+        ret['parallel'] = False # the number is output once for the whole input
+        return ret
+    
+    def fusable(self):
+        return True
+    
     def run(self, input_channel):
         yield jqsh.values.Number(self.number)
+    
+    def run_fused(self, values, input_channel):
+        yield jqsh.values.Number(self.number)
 
 class StringLiteral(Filter):
     def __init__(self, text):
@@ -296,12 +544,23 @@ class StringLiteral(Filter):
         else:
             return character
     
+    def explain(self):
+        ret = super().explain()
+        ret['parallel'] = False # the string is output once for the whole input
+        return ret
+    
+    def fusable(self):
+        return True
+    
     @staticmethod
     def representation(the_string):
         return '"' + ''.join(StringLiteral.escape(character) for character in str(the_string)) + '"'
     
     def run(self, input_channel):
         yield jqsh.values.String(self.text)
+    
+    def run_fused(self, values, input_channel):
+        yield jqsh.values.String(self.text)
 
 class Operator(Filter):
     """Abstract base class for operator filters."""
@@ -316,33 +575,130 @@ class Operator(Filter):
     def __str__(self):
         return str(self.left_operand) + self.operator_string + str(self.right_operand)
     
+    def children(self):
+        return self.left_operand, self.right_operand
+    
+    def explain(self):
+        """The default for operators using output_pairs."""
+        ret = super().explain()
+        ret['buffers'] = 'the outputs of the operand that ends first, to cycle through them'
+        ret['parallel'] = any(operand.__class__ in (NumberLiteral, StringLiteral) and other_operand.explain()['parallel'] for operand, other_operand in ((self.left_operand, self.right_operand), (self.right_operand, self.left_operand))) # a constant operand is paired with each value of the other
+        ret['splits'] = 1
+        ret['threads'] += 6
+        return ret
+    
+    def fusable(self):
+        """The default for operators using output_pairs: fusable if one operand is a literal, so the input need not be split."""
+        return any(operand.__class__ in (NumberLiteral, StringLiteral) and other_operand.fusable() for operand, other_operand in ((self.left_operand, self.right_operand), (self.right_operand, self.left_operand)))
+    
     def output_pairs(self, input_channel):
-        #TODO don't block until both operands have terminated
+        """Yields pairs of the i-th outputs of the operands, cycling through the outputs of the operand that ends first until the other one ends. If an operand has no outputs, the outputs of the other are yielded unpaired.
+        
+        Pairs are yielded as soon as both operands have produced their values. Once an operand ends, only its outputs are kept for cycling, so an operand with a single output, such as a literal, takes constant memory.
+        """
         left_input, right_input = input_channel / 2
-        left_output = list(self.left_operand.start(left_input))
-        right_output = list(self.right_operand.start(right_input))
-        if len(left_output) == 0 and len(right_output) == 0:
+        yield from self.pairs(self.left_operand.start(left_input), self.right_operand.start(right_input))
+    
+    def run_fused(self, values, input_channel):
+        """The default for operators using output_pairs, see fusable. Subclasses implement run_pairs."""
+        yield from self.run_pairs(self.pairs(self.left_operand.run_fused(values, input_channel), self.right_operand.run_fused(values, input_channel))) # one operand is a literal, so only the other one reads the values
+    
+    @staticmethod
+    def pairs(left_output, right_output):
+        """The pairing of output_pairs, for iterators of the outputs of the operands."""
+        left_values = []
+        right_values = []
+        while True:
+            left_value = next(left_output, None) # channels contain jqsh values, so None marks the end
+            right_value = next(right_output, None)
+            if left_value is None or right_value is None:
+                break
+            left_values.append(left_value)
+            right_values.append(right_value)
+            yield left_value, right_value
+        if left_value is None and right_value is None:
             return
-        elif len(left_output) == 0:
-            yield from right_output
-        elif len(right_output) == 0:
-            yield from left_output
+        elif left_value is None:
+            del right_values # only the outputs of the operand that ended are cycled through
+            if len(left_values) == 0:
+                yield right_value
+                yield from right_output
+                return
+            for i, right_value in enumerate(itertools.chain([right_value], right_output), len(left_values)):
+                yield left_values[i % len(left_values)], right_value
         else:
-            for i in range(max(len(left_output), len(right_output))):
-                yield left_output[i % len(left_output)], right_output[i % len(right_output)]
+            del left_values
+            if len(right_values) == 0:
+                yield left_value
+                yield from left_output
+                return
+            for i, left_value in enumerate(itertools.chain([left_value], left_output), len(right_values)):
+                yield left_value, right_values[i % len(right_values)]
 
 class Pipe(Operator): #TODO add correct namespace handling
     operator_string = ' | '
     
+    def explain(self):
+        ret = Filter.explain(self)
+        ret['fused'] = tuple(operand for operand in (self.left_operand, self.right_operand) if operand.fusable())
+        ret['parallel'] = self.left_operand.explain()['parallel'] and self.right_operand.explain()['parallel']
+        if len(ret['fused']) == 1 and ret['fused'][0] is self.left_operand:
+            ret['threads'] = 7 # the filter thread, the thread running the left operand, and push_namespaces with a thread for each of the 4 namespaces
+        elif len(ret['fused']):
+            ret['threads'] = 6 # the filter thread, and push_namespaces with a thread for each of the 4 namespaces
+        return ret
+    
+    def fusable(self):
+        return self.left_operand.fusable() and self.right_operand.fusable()
+    
     def run(self, input_channel):
         left_output = self.left_operand.start(input_channel)
         yield from self.right_operand.start(left_output)
+    
+    def run_fused(self, values, input_channel):
+        yield from self.right_operand.stream(self.left_operand.stream(values, input_channel), input_channel)
+    
+    def run_raw(self, input_channel, output_channel):
+        """Runs the fusable operands in the filter thread, passing values between them without channels. A channel is only used to pass values to or from an operand that is not fusable, which runs in its own filter thread. While profiling or tracing, the operands are not fused."""
+        def push_values(values, values_channel):
+            try:
+                for value in values:
+                    values_channel.push(value)
+            except Exception as e:
+                import traceback
+                
+                values_channel.throw(jqsh.values.JQSHException('internal', python_exception=e, exc_info=sys.exc_info(), traceback_string=traceback.format_exc()))
+            else:
+                values_channel.terminate()
+        
+        if jqsh.channel.instrumented():
+            super().run_raw(input_channel, output_channel)
+            return
+        elif self.fusable():
+            values = self.stream(input_channel, input_channel)
+        elif self.left_operand.fusable():
+            left_output = jqsh.channel.Channel()
+            jqsh.channel.Thread(target=push_values, args=(self.left_operand.stream(input_channel, input_channel), left_output)).start()
+            values = self.right_operand.start(left_output)
+        elif self.right_operand.fusable():
+            left_output = self.left_operand.start(input_channel)
+            values = self.right_operand.stream(left_output, left_output)
+        else:
+            super().run_raw(input_channel, output_channel)
+            return
+        handle_namespaces = jqsh.channel.Thread(target=input_channel.push_namespaces, args=(output_channel,) if self.right_operand.fusable() else (output_channel, left_output))
+        handle_namespaces.start()
+        push_values(values, output_channel)
+        handle_namespaces.join()
 
 class Add(Operator):
     operator_string = ' + '
     
     def run(self, input_channel):
-        for output in self.output_pairs(input_channel):
+        yield from self.run_pairs(self.output_pairs(input_channel))
+    
+    def run_pairs(self, pairs):
+        for output in pairs:
             if isinstance(output, tuple):
                 left_output, right_output = output
             else:
@@ -371,6 +727,8 @@ class Apply(Operator):
         else:
             self.attributes = [left, right]
             self.variadic_form = False
+        self.path = self.lookup_path()
+        self.builtin = self.link_builtin()
     
     def __repr__(self):
         if self.variadic_form:
@@ -384,6 +742,117 @@ class Apply(Operator):
         else:
             return str(self.attributes[0]) + '.' + str(self.attributes[1])
     
+    def children(self):
+        return tuple(self.attributes)
+    
+    def explain(self):
+        ret = Filter.explain(self)
+        if all(attribute.__class__ == Filter for attribute in self.attributes): # identity function
+            ret['threads'] = 5 # the filter thread, and a thread for each of the 4 namespaces
+        elif len(self.attributes) == 2 and all(attribute.__class__ == NumberLiteral for attribute in self.attributes): # decimal number
+            ret['parallel'] = False
+            ret['threads'] = 5
+        elif self.path is not None: # lookup with a path of literal keys
+            ret['not_started'] = tuple(self.attributes) # the keys are compiled into the path
+            ret['threads'] = 5
+        elif self.attributes[0].__class__ == Filter: # subscripting/lookup on input values
+            ret['buffers'] = 'each object, until the key is found'
+            ret['parallel'] = self.attributes[1].__class__ in (NumberLiteral, StringLiteral) # the key is evaluated once, for the whole input
+            ret['splits'] = 1
+            ret['threads'] = 11 # the filter thread, the split, and a thread for each of the 4 namespaces
+        elif self.attributes[0].__class__ == Command: # command with arguments
+            ret['not_started'] = self.attributes[0],
+            ret['parallel'] = False # one process reads the whole input
+            ret['splits'] = 1
+            ret['threads'] = 12 # the filter thread, the split, the command input writer, and a thread for each of the 4 namespaces
+        else: # built-in function with arguments
+            function_name = self.attributes[0].name if self.attributes[0].__class__ == Name else None
+            if function_name is not None:
+                ret['not_started'] = self.attributes[0],
+            ret['parallel'] = function_name in jqsh.functions.parallel_builtins
+            if function_name in jqsh.functions.per_value_builtins:
+                ret['per_value'] = self.attributes[1 + jqsh.functions.per_value_builtins[function_name]],
+            ret['splits'] = (1 if function_name in ('for', 'nth', 'reduce') else 0) + (0 if self.builtin is not None else 1) # those builtins split their input again, and the function name is computed on a split unless the builtin is linked
+            ret['threads'] = 7 + 6 * ret['splits'] # the filter thread, the splits, and the threads of wrap_builtin
+        return ret
+    
+    def fusable(self):
+        if all(attribute.__class__ == Filter for attribute in self.attributes): # identity function
+            return True
+        elif len(self.attributes) == 2 and all(attribute.__class__ == NumberLiteral for attribute in self.attributes): # decimal number
+            return True
+        elif self.path is not None: # lookup with a path of literal keys
+            return True
+        elif len(self.attributes) == 2 and self.attributes[0].__class__ == Name and self.attributes[0].name == 'each':
+            return self.attributes[1].fusable()
+        return False
+    
+    def link_builtin(self):
+        """Returns the builtin function called by this filter if the function name is a Name, or None. The builtin is resolved when the filter is created, so calling it needs no thread to compute the function name and no lookup. Like other function calls, this does not check for local variables of the same name."""
+        if self.attributes[0].__class__ != Name:
+            return None
+        try:
+            return jqsh.functions.get_builtin(self.attributes[0].name, *self.attributes[1:])
+        except KeyError:
+            return None
+    
+    @staticmethod
+    def lookup(path, values):
+        """Yields the value at the path, a sequence of keys, in each input value. If a key cannot be looked up, an exception is yielded instead, and nothing after it."""
+        steps = [(key, int(key) if isinstance(key, jqsh.values.Number) and key % 1 == 0 else None) for key in path] # the array index for each key, if it is an integer
+        for value in values:
+            for key, index in steps:
+                if isinstance(value, jqsh.values.Object):
+                    if key not in value:
+                        yield jqsh.values.JQSHException('key')
+                        return
+                    value = value[key]
+                elif isinstance(value, jqsh.values.Array) and isinstance(key, jqsh.values.Number):
+                    if index is None:
+                        yield jqsh.values.JQSHException('integer')
+                        return
+                    try:
+                        value = value[index]
+                    except IndexError:
+                        yield jqsh.values.JQSHException('index')
+                        return
+                else:
+                    yield jqsh.values.JQSHException('type')
+                    return
+            yield value
+    
+    def lookup_path(self):
+        """Returns the keys of a lookup with literal keys, such as ."a"."b".0, as a tuple, or None if this is not such a lookup. The path is compiled when the filter is created, so the lookup is done in one pass over each value, without running the keys."""
+        if len(self.attributes) != 2:
+            return None
+        left, right = self.attributes
+        if right.__class__ == NumberLiteral:
+            key = right.number
+        elif right.__class__ == StringLiteral:
+            key = jqsh.values.String(right.text)
+        else:
+            return None
+        if left.__class__ == Filter:
+            return key,
+        elif left.__class__ == Apply and left.path is not None:
+            return left.path + (key,)
+        return None
+    
+    def run_fused(self, values, input_channel):
+        if all(attribute.__class__ == Filter for attribute in self.attributes): # identity function
+            yield from values
+        elif len(self.attributes) == 2 and all(attribute.__class__ == NumberLiteral for attribute in self.attributes): # decimal number
+            yield jqsh.values.Number(str(self.attributes[0]) + '.' + str(self.attributes[1]))
+        elif self.path is not None: # lookup with a path of literal keys
+            yield from self.lookup(self.path, values)
+        else: # each
+            memo = input_channel.context.memo
+            for value in values:
+                if memo is None:
+                    yield from self.attributes[1].stream(iter([value]), input_channel)
+                else:
+                    yield from memo.outputs(self.attributes[1], [value], input_channel, lambda: list(self.attributes[1].stream(iter([value]), input_channel)))
+    
     def run_raw(self, input_channel, output_channel):
         if all(attribute.__class__ == Filter for attribute in self.attributes): # identity function
             output_channel.get_namespaces(input_channel)
@@ -393,6 +862,14 @@ class Apply(Operator):
             output_channel.terminate()
             output_channel.get_namespaces(input_channel)
             return
+        elif self.path is not None: # lookup with a path of literal keys
+            for value in self.lookup(self.path, input_channel):
+                if isinstance(value, jqsh.values.JQSHException):
+                    output_channel.throw(value)
+                    return
+                output_channel.push(value)
+            output_channel.terminate()
+            output_channel.get_namespaces(input_channel)
         elif self.attributes[0].__class__ == Filter: # subscripting/lookup on input values
             #TODO support variadic form (recursive run_raw calls)
             input_channel, key_input = input_channel / 2
@@ -401,30 +878,11 @@ class Apply(Operator):
             except StopIteration:
                 output_channel.throw('empty')
                 return
-            for value in input_channel:
-                if isinstance(value, jqsh.values.Object):
-                    if key in value:
-                        output_channel.push(value[key])
-                    else:
-                        output_channel.throw('key')
-                        return
-                elif isinstance(value, jqsh.values.Array):
-                    if isinstance(key, jqsh.values.Number):
-                        if key % 1 == 0:
-                            try:
-                                output_channel.push(value[int(key)])
-                            except IndexError:
-                                output_channel.throw('index')
-                                return
-                        else:
-                            output_channel.throw('integer')
-                            return
-                    else:
-                        output_channel.throw('type')
-                        return
-                else:
-                    output_channel.throw('type')
+            for value in self.lookup((key,), input_channel):
+                if isinstance(value, jqsh.values.JQSHException):
+                    output_channel.throw(value)
                     return
+                output_channel.push(value)
             output_channel.terminate()
             output_channel.get_namespaces(input_channel)
             return
@@ -437,10 +895,12 @@ class Apply(Operator):
             except (StopIteration, TypeError):
                 output_channel.throw('sensibleString')
                 return
-            for value in Command.run_command(command_name, input_channel):
+            for value in Command.outputs(command_name, input_channel):
                 output_channel.push(value)
             output_channel.get_namespaces(input_channel)
             output_channel.terminate()
+        elif self.builtin is not None and input_channel.context.linked_builtins: # built-in function resolved when the filter was created
+            self.builtin(*self.attributes[1:], input_channel=input_channel, output_channel=output_channel)
         else: # built-in function with arguments
             input_channel, string_input = input_channel / 2
             try:
@@ -459,6 +919,20 @@ class Apply(Operator):
 class Assign(Operator):
     operator_string = ' = '
     
+    def explain(self):
+        ret = Filter.explain(self)
+        ret['buffers'] = 'all values assigned to the variable'
+        ret['parallel'] = False
+        ret['splits'] = 1
+        ret['threads'] = 11 # the filter thread, the split, and the 4 threads of assign
+        return ret
+    
+    def fusable(self):
+        return False
+    
+    def pure(self):
+        return False # the namespace is changed
+    
     def run_raw(self, input_channel, output_channel):
         input_channel, assignment_input = input_channel / 2
         try:
@@ -471,6 +945,16 @@ class Comma(Operator):
     def __str__(self):
         return str(self.left_operand) + ', ' + str(self.right_operand)
     
+    def explain(self):
+        ret = Filter.explain(self)
+        ret['parallel'] = False # the output of the right operand for the whole input comes after that of the left operand
+        ret['splits'] = 1
+        ret['threads'] += 6
+        return ret
+    
+    def fusable(self):
+        return False
+    
     def run(self, input_channel):
         left_input, right_input = input_channel / 2
         right_output = self.right_operand.start(right_input)
@@ -481,7 +965,12 @@ class Multiply(Operator):
     operator_string = ' * '
     
     def run(self, input_channel):
-        for output in self.output_pairs(input_channel):
+        yield from self.run_pairs(self.output_pairs(input_channel))
+    
+    def run_pairs(self, pairs):
+        import more_itertools
+        
+        for output in pairs:
             if isinstance(output, tuple):
                 left_output, right_output = output
             else:
@@ -515,6 +1004,16 @@ class Multiply(Operator):
 class Pair(Operator):
     operator_string = ': '
     
+    def explain(self):
+        ret = Filter.explain(self)
+        ret['parallel'] = self.right_operand.__class__ in (NumberLiteral, StringLiteral) and self.left_operand.explain()['parallel']
+        ret['splits'] = 1
+        ret['threads'] += 6
+        return ret
+    
+    def fusable(self):
+        return False
+    
     def run(self, input_channel):
         left_input, right_input = input_channel / 2
         try:
@@ -528,6 +1027,16 @@ class Pair(Operator):
 class Semicolon(Operator):
     operator_string = '; '
     
+    def explain(self):
+        ret = Filter.explain(self)
+        ret['parallel'] = False # the left operand may define variables from the whole input
+        ret['splits'] = 1
+        ret['threads'] = 15 # the filter thread, the split, and two times a thread for each of the 4 namespaces
+        return ret
+    
+    def fusable(self):
+        return False
+    
     def run_raw(self, input_channel, output_channel):
         left_input, right_input = input_channel / 2
         left_output = self.left_operand.start(left_input)
@@ -549,13 +1058,38 @@ class UnaryOperator(Filter):
     
     def __str__(self):
         return self.operator_string + str(self.attribute)
+    
+    def children(self):
+        return self.attribute,
 
 class Command(UnaryOperator):
     operator_string = '!'
     
+    def explain(self):
+        ret = super().explain()
+        ret['parallel'] = False # one process reads the whole input
+        ret['splits'] = 1
+        ret['threads'] += 7 # the split and the command input writer
+        return ret
+    
+    @staticmethod
+    def outputs(command_name, input_channel):
+        """Yields the output of the command. If the context has a coprocess pool, each input value is sent to a process from the pool, otherwise one new process reads the whole input."""
+        coprocesses = input_channel.context.coprocesses
+        if coprocesses is None:
+            yield from Command.run_command(command_name, input_channel)
+        else:
+            command_line = command_name if isinstance(command_name, str) else tuple(command_name) # command lines with arguments are lists, which cannot be pool keys
+            for value in input_channel:
+                yield from coprocesses.run(command_line, value)
+    
+    def pure(self):
+        return False
+    
     @staticmethod
     def run_command(command_name, input_channel):
         import jqsh.parser
+        import subprocess
         
         try:
             popen = subprocess.Popen(command_name, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
@@ -565,15 +1099,37 @@ class Command(UnaryOperator):
         except PermissionError:
             yield jqsh.values.JQSHException('permission')
             return
-        for value in input_channel:
-            popen.stdin.write(str(value).encode('utf-8') + b'\n')
-        popen.stdin.write(b'\x04')
-        with contextlib.suppress(BrokenPipeError):
-            popen.stdin.close()
+        def write_input():
+            try:
+                while True:
+                    try:
+                        value = input_channel.pop(wait=False)
+                    except queue.Empty:
+                        popen.stdin.flush() # the command gets the values written so far while the next one is computed
+                        value = input_channel.pop()
+                    for chunk in jqsh.values.serialize_bytes(value):
+                        popen.stdin.write(chunk)
+                    popen.stdin.write(b'\n')
+            except StopIteration:
+                pass # the input has ended
+            except BrokenPipeError:
+                pass # the command exited without reading all of its input
+            finally:
+                with contextlib.suppress(BrokenPipeError):
+                    popen.stdin.close()
+        
+        # feed the input from a separate thread so that a command that writes before it has read all of its input cannot deadlock on full pipes
+        jqsh.channel.Thread(target=write_input, name='jqsh command input', daemon=True).start()
         try:
-            yield from jqsh.parser.parse_json_values(popen.stdout.read().decode('utf-8')) #TODO don't read everything before starting to decode
+            yield from jqsh.parser.parse_json_lines(popen.stdout)
         except (UnicodeDecodeError, SyntaxError, jqsh.parser.Incomplete):
             yield jqsh.values.JQSHException('commandOutput')
+        except GeneratorExit:
+            popen.kill() # the output is no longer needed
+            raise
+        finally:
+            popen.stdout.close()
+            popen.wait()
     
     def run(self, input_channel):
         input_channel, attribute_input = input_channel / 2
@@ -582,42 +1138,43 @@ class Command(UnaryOperator):
         except (StopIteration, TypeError):
             yield jqsh.values.JQSHException('sensibleString')
             return
-        yield from self.run_command(command_name, input_channel)
+        yield from self.outputs(command_name, input_channel)
 
 class GlobalVariable(UnaryOperator):
     operator_string = '$'
     
     def assign(self, value_channel, input_channel, output_channel):
-        handle_locals = threading.Thread(target=input_channel.push_attribute, args=('local_namespace', output_channel))
-        handle_format_strings = threading.Thread(target=input_channel.push_attribute, args=('format_strings', output_channel))
-        handle_context = threading.Thread(target=input_channel.push_attribute, args=('context', output_channel))
-        handle_values = threading.Thread(target=output_channel.pull, args=(input_channel,))
+        handle_locals = jqsh.channel.Thread(target=input_channel.push_attribute, args=('local_namespace', output_channel))
+        handle_format_strings = jqsh.channel.Thread(target=input_channel.push_attribute, args=('format_strings', output_channel))
+        handle_context = jqsh.channel.Thread(target=input_channel.push_attribute, args=('context', output_channel))
+        handle_values = jqsh.channel.Thread(target=output_channel.pull, args=(input_channel,))
         handle_locals.start()
         handle_format_strings.start()
         handle_context.start()
         handle_values.start()
-        input_globals = copy.copy(input_channel.global_namespace)
         try:
             variable_name = self.attribute.sensible_string(input_channel)
         except (StopIteration, TypeError):
             output_channel.throw('sensibleString')
+            output_channel.global_namespace = input_channel.global_namespace
         else:
-            var = list(value_channel)
-            for value in var:
-                if isinstance(value, jqsh.values.JQSHException):
-                    output_channel.throw(value)
-                    break
-            else:
-                input_globals[variable_name] = var
-        output_channel.global_namespace = input_globals
-        output_channel.terminate()
+            output_channel.global_namespace = jqsh.channel.Namespace({variable_name: jqsh.channel.ReplayBuffer(value_channel)}, parent=input_channel.global_namespace) # pull terminates the output channel
         handle_locals.join()
         handle_format_strings.join()
         handle_context.join()
         handle_values.join()
     
+    def explain(self):
+        ret = super().explain()
+        ret['parallel'] = False # the variable is output once for the whole input
+        ret['threads'] = 6 # the filter thread, and push_namespaces with a thread for each of the 4 namespaces
+        return ret
+    
+    def pure(self):
+        return False # the variable depends on the namespace
+    
     def run_raw(self, input_channel, output_channel):
-        handle_namespaces = threading.Thread(target=input_channel.push_namespaces, args=(output_channel,))
+        handle_namespaces = jqsh.channel.Thread(target=input_channel.push_namespaces, args=(output_channel,))
         handle_namespaces.start()
         try:
             variable_name = self.attribute.sensible_string(input_channel)
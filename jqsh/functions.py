@@ -5,9 +5,12 @@ import jqsh.channel
 import jqsh.filter
 import jqsh.values
 import builtins as python_builtins
-import threading
 
 builtin_functions = collections.defaultdict(dict)
+fusable_builtins = {'empty', 'explode', 'range'} # only iterate over their input, so jqsh.filter.Name.run_fused can call their generators with an iterator
+parallel_builtins = {'each', 'empty', 'explode', 'range'} # handle each input value on its own, see jqsh.filter.Filter.explain
+pure_builtins = {'each', 'empty', 'explode', 'false', 'for', 'implode', 'nth', 'null', 'range', 'reduce', 'true'} # outputs only depend on the input values and arguments, see jqsh.filter.Filter.pure
+per_value_builtins = {'each': 0, 'for': 1, 'reduce': 1} # name: index of the argument that is started once for each input value
 
 def get_builtin(name, *args, num_args=None):
     if num_args is None:
@@ -42,8 +45,8 @@ def wrap_builtin(f):
                 output_channel.push(value)
         
         bridge_channel = jqsh.channel.Channel()
-        helper_thread = threading.Thread(target=run_thread, kwargs={'bridge': bridge_channel})
-        handle_namespaces = threading.Thread(target=input_channel.push_namespaces, args=(bridge_channel, output_channel))
+        helper_thread = jqsh.channel.Thread(target=run_thread, kwargs={'bridge': bridge_channel})
+        handle_namespaces = jqsh.channel.Thread(target=input_channel.push_namespaces, args=(bridge_channel, output_channel))
         helper_thread.start()
         handle_namespaces.start()
         for value in input_channel:
@@ -56,8 +59,26 @@ def wrap_builtin(f):
         helper_thread.join()
         handle_namespaces.join()
         output_channel.terminate()
+    
+    wrapper.generator = f
     return wrapper
 
+def run_loop_body(body, state, input_channel):
+    """Runs the body of for or reduce on the values of the previous iteration, with the namespaces and context of the input channel, and returns its outputs as a list.
+    
+    Each iteration is run to completion before the next one starts, so a loop keeps a constant number of threads and channels alive, however many times it runs. A fusable body is run in the calling thread unless it is profiled or traced. The outputs are cached if the context has a jqsh.memo.Memo.
+    """
+    def run():
+        if body.fusable() and not jqsh.channel.instrumented():
+            return list(body.stream(state, input_channel))
+        global_namespace, local_namespace, format_strings = input_channel.namespaces()
+        return list(body.start(jqsh.channel.Channel(*state, global_namespace=global_namespace, local_namespace=local_namespace, format_strings=format_strings, context=input_channel.context, terminated=True)))
+    
+    memo = input_channel.context.memo
+    if memo is None:
+        return run()
+    return memo.outputs(body, state, input_channel, run)
+
 @def_builtin(0)
 @wrap_builtin
 def argv(input_channel):
@@ -86,10 +107,17 @@ def argv(index, input_channel):
 @def_builtin(1)
 @wrap_builtin
 def each(the_filter, input_channel):
-    for value in input_channel:
+    def run(value):
         value_input = jqsh.channel.Channel(value, terminated=True, empty_namespaces=False)
-        threading.Thread(target=value_input.get_namespaces, args=(input_channel,)).start()
-        yield from the_filter.start(value_input)
+        jqsh.channel.Thread(target=value_input.get_namespaces, args=(input_channel,)).start()
+        return the_filter.start(value_input)
+    
+    memo = input_channel.context.memo
+    for value in input_channel:
+        if memo is None:
+            yield from run(value)
+        else:
+            yield from memo.outputs(the_filter, [value], input_channel, lambda: list(run(value)))
 
 @def_builtin(0)
 @wrap_builtin
@@ -120,11 +148,12 @@ def isMain(input_channel):
 @wrap_builtin
 def jqsh_for(initial, body, input_channel):
     input_channel, initial_input = input_channel / 2
-    output_channel = initial.start(initial_input)
+    state = list(initial.start(initial_input))
     for value in input_channel:
-        output_channel = body.start(output_channel)
-        output_channel, current_output = output_channel / 2
-        yield from current_output
+        state = run_loop_body(body, state, input_channel)
+        yield from state
+        if any(isinstance(state_value, jqsh.values.JQSHException) for state_value in state):
+            return
 
 @def_builtin(0)
 @wrap_builtin
@@ -198,10 +227,12 @@ def range(input_channel):
 @wrap_builtin
 def reduce(initial, body, input_channel):
     input_channel, initial_input = input_channel / 2
-    output_channel = initial.start(initial_input)
+    state = list(initial.start(initial_input))
     for value in input_channel:
-        output_channel = body.start(output_channel)
-    yield from output_channel
+        if any(isinstance(state_value, jqsh.values.JQSHException) for state_value in state):
+            break
+        state = run_loop_body(body, state, input_channel)
+    yield from state
 
 @def_builtin(0)
 @wrap_builtin
@@ -0,0 +1,41 @@
+import collections
+import threading
+
+class Memo:
+    """A cache of the outputs of pure filters, used by the builtins that run a filter once for each input value, such as each and reduce, if the context has one.
+    
+    Outputs are keyed on the filter node, the local namespace it runs with, and the serialized input values, so equal values with the same key order hit the same entry. Only the max_size most recently used entries are kept.
+    """
+    hits = 0
+    misses = 0
+    
+    def __init__(self, max_size=1024):
+        self.cache = collections.OrderedDict() # key: (filter, local namespace, outputs), which keeps the filter and namespace alive so their ids are not reused
+        self.lock = threading.Lock()
+        self.max_size = max_size
+    
+    def outputs(self, the_filter, values, input_channel, run):
+        """Returns the outputs of the filter for the input values as a list, calling run without arguments to compute them if they are not cached. Filters that are not pure are always run, and outputs with exceptions are not cached."""
+        import jqsh.values
+        
+        if not the_filter.pure():
+            return run()
+        local_namespace = input_channel.local_namespace
+        key = id(the_filter), id(local_namespace), tuple(''.join(jqsh.values.serialize(value, compact=True, sort_keys=False)) for value in values) # objects with different key orders are different inputs, since filters keep the order
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return list(self.cache[key][2])
+            self.misses += 1
+        ret = run()
+        if not any(isinstance(value, jqsh.values.JQSHException) for value in ret):
+            with self.lock:
+                self.cache[key] = the_filter, local_namespace, ret
+                while len(self.cache) > self.max_size:
+                    self.cache.popitem(last=False)
+        return list(ret)
+    
+    def report_line(self):
+        with self.lock:
+            return '{} hits, {} misses, {} cached results'.format(self.hits, self.misses, len(self.cache))
@@ -3,6 +3,10 @@ import enum
 import jqsh.context
 import jqsh.filter
 import jqsh.values
+import mmap
+import os
+import re
+import stat
 import string
 import unicodedata
 
@@ -43,6 +47,8 @@ TokenType = enum.Enum('TokenType', [
 ], module=__name__)
 
 class Token:
+    __slots__ = ('type', 'string', 'text', 'line', 'column')
+    
     def __eq__(self, other):
         return self.type is other.type and self.text == other.text
     
@@ -68,6 +74,8 @@ atomic_tokens = {
     TokenType.string: jqsh.filter.StringLiteral
 }
 
+end_keyword = Token(TokenType.name, text='end') # compared against in the parser's inner loop, so it is only constructed once
+
 escapes = { # string literal escape sequences, sans \u and \(
     '"': '"',
     '/': '/',
@@ -169,6 +177,19 @@ symbols = {
     '}': TokenType.close_object
 }
 
+symbols_longest_first = sorted(symbols.items(), key=lambda pair: -len(pair[0])) # look at longer symbols first, so that a += is not mistakenly tokenized as a +
+
+json_byte_symbols = {ord(symbol): token_type for symbol, token_type in symbols.items() if token_type in json_tokens} # maps byte values to token types for tokenize_json_bytes
+
+token_patterns = { # runs of characters that are consumed in one step by the tokenizer
+    'json_bytes': re.compile(b'[' + re.escape(string.whitespace.encode('ascii')) + rb']*(?:(?P<symbol>[\[\]{}:,])|"(?P<string>[^"\\]*(?:\\.[^"\\]*)*)"|(?P<number>[0-9]+)|(?P<name>[A-Za-z]+))?', re.DOTALL),
+    'json_escape': re.compile(r'\\(?:u([0-9A-Fa-f]{4})|(.))', re.DOTALL),
+    'name': re.compile('[' + string.ascii_letters + ']+'),
+    'number': re.compile('[' + string.digits + ']+'),
+    'string': re.compile(r'[^"\\]+'),
+    'whitespace': re.compile('[' + re.escape(string.whitespace) + ']+')
+}
+
 def illegal_token_exception(token, position=None, expected=None, line_numbers=False):
     if token.type is TokenType.illegal and token.text:
         return SyntaxError('illegal character' + ((' in line ' + str(token.line) if line_numbers and token.line is not None else '') if position is None else ' at position ' + repr(position)) + ': ' + repr(token.text[0]) + ' (U+' + format(ord(token.text[0]), 'x').upper() + ' ' + unicodedata.name(token.text[0], 'unknown character') + ')')
@@ -193,9 +214,119 @@ def parse(tokens, *, line_numbers=False, allowed_filters={'default': True}, cont
         else:
             return False
     
-    def make_keyword_paren_filter(attributes):
-        attributes = list(attributes)
-        return keyword_paren_filters[attributes[0][0]]((attribute_name, parse(attribute_tokens, line_numbers=line_numbers, allowed_filters=allowed_filters, context=context)) for attribute_name, attribute_tokens in attributes)
+    def parse_range(start, stop):
+        """Parses tokens[start:stop] in place, replacing the range with a single filter. Tokens outside the range are not touched."""
+        tail = len(tokens) - stop # the number of tokens after the range, which stays the same while the range shrinks
+        if start == stop:
+            tokens.insert(start, raise_for_filter(jqsh.filter.Filter())) # token range is empty, use an empty filter
+            return
+        
+        # parenthesis-like filters
+        paren_balance = 0
+        paren_start = None
+        middle_keywords = []
+        for i in range(stop - 1, start - 1, -1): # iterating over the token range in reverse because we modify it in the process
+            token = tokens[i]
+            if not isinstance(token, Token):
+                continue
+            elif token.type in matching_parens.values() or token == end_keyword:
+                if paren_balance == 0:
+                    paren_start = i
+                    if token == end_keyword:
+                        middle_keywords = []
+                paren_balance += 1
+            elif token.type in matching_parens.keys() or token.type is TokenType.name and token.text in keyword_parens.keys():
+                paren_balance -= 1
+                if paren_balance < 0:
+                    raise Incomplete('too many opening parens of type ' + repr(token.text if token.type is TokenType.name else token.type))
+                elif paren_balance == 0:
+                    if token.type is TokenType.name:
+                        middle_keywords = [index for index in middle_keywords if tokens[index].text in keyword_parens[token.text]]
+                        attributes = []
+                        last_index = paren_start
+                        for index in middle_keywords: # descending, so parsing an attribute does not move the keywords before it
+                            parse_range(index + 1, last_index)
+                            attributes.append((tokens[index].text, tokens[index + 1]))
+                            last_index = index
+                        parse_range(i + 1, last_index)
+                        attributes.append((token.text, tokens[i + 1]))
+                        tokens[i:i + 2 * len(attributes) + 1] = [raise_for_filter(keyword_paren_filters[token.text](reversed(attributes)))]
+                    else:
+                        if matching_parens[token.type] is tokens[paren_start].type:
+                            parse_range(i + 1, paren_start) # parse the inside of the parens
+                            tokens[i:i + 3] = [raise_for_filter(paren_filters[token.type](attribute=tokens[i + 1]))]
+                        else:
+                            raise SyntaxError('opening paren of type ' + repr(token.type) + ' does not match closing paren of type ' + repr(tokens[paren_start].type))
+                    paren_start = None
+            elif paren_balance == 1 and token.type is TokenType.name:
+                middle_keywords.append(i)
+        if paren_balance != 0:
+            raise SyntaxError('mismatched parens')
+        
+        # atomic filters
+        for i in range(len(tokens) - tail - 1, start - 1, -1):
+            token = tokens[i]
+            if isinstance(token, Token) and token.type in atomic_tokens:
+                tokens[i] = raise_for_filter(atomic_tokens[token.type](token.text))
+        
+        # operators
+        for precedence_group in operators:
+            if precedence_group == 'variadic apply':
+                run_end = None
+                for i in range(len(tokens) - tail - 1, start - 1, -1):
+                    if isinstance(tokens[i], jqsh.filter.Filter):
+                        if run_end is None:
+                            run_end = i
+                    else:
+                        if run_end is not None and run_end > i + 1:
+                            tokens[i + 1:run_end + 1] = [raise_for_filter(jqsh.filter.Apply(*tokens[i + 1:run_end + 1]))]
+                        run_end = None
+                if run_end is not None and run_end > start:
+                    tokens[start:run_end + 1] = [raise_for_filter(jqsh.filter.Apply(*tokens[start:run_end + 1]))]
+                continue
+            if not precedence_group.get('binary', True):
+                for i in range(len(tokens) - tail - 1, start - 1, -1):
+                    token = tokens[i]
+                    if isinstance(token, Token) and token.type in precedence_group:
+                        if len(tokens) - tail == i + 1:
+                            raise SyntaxError('expected a filter after ' + repr(token) + ', nothing found')
+                        elif isinstance(tokens[i + 1], Token):
+                            raise SyntaxError('expected a filter after ' + repr(token) + ', found ' + repr(tokens[i + 1]) + ' instead')
+                        tokens[i:i + 2] = [raise_for_filter(precedence_group[token.type](attribute=tokens[i + 1]))]
+                continue
+            # binary operators are combined in visiting order: left to right for left-associative groups, right to left otherwise
+            ltr = not precedence_group.get('rtl', False)
+            step = 1 if ltr else -1
+            operator_class = None
+            left_operand = None
+            right_operand = None
+            has_previous_operand = False # does the current operator have an operand on the already visited side?
+            has_next_operand = False # does the current operator have an operand on the side that is visited next?
+            i = start if ltr else len(tokens) - tail - 1
+            while start <= i < len(tokens) - tail:
+                token = tokens[i]
+                if isinstance(token, jqsh.filter.Filter) and has_next_operand:
+                    replaced = 3 if has_previous_operand else 2
+                    if ltr:
+                        i -= replaced - 1
+                    tokens[i:i + replaced] = [operator_class(left=left_operand, right=right_operand)]
+                    has_next_operand = False
+                elif isinstance(token, Token) and token.type in precedence_group:
+                    previous_operand, has_previous_operand = (tokens[i - step], True) if start <= i - step < len(tokens) - tail and isinstance(tokens[i - step], jqsh.filter.Filter) else (raise_for_filter(jqsh.filter.Filter()), False)
+                    next_operand, has_next_operand = (tokens[i + step], True) if start <= i + step < len(tokens) - tail and isinstance(tokens[i + step], jqsh.filter.Filter) else (raise_for_filter(jqsh.filter.Filter()), False)
+                    left_operand, right_operand = (previous_operand, next_operand) if ltr else (next_operand, previous_operand)
+                    operator_class = precedence_group[token.type]
+                    if not has_next_operand:
+                        replaced = 2 if has_previous_operand else 1
+                        if ltr:
+                            i -= replaced - 1
+                        tokens[i:i + replaced] = [operator_class(left=left_operand, right=right_operand)]
+                else:
+                    has_next_operand = False
+                i += step
+        
+        if len(tokens) - tail - start != 1 or not isinstance(tokens[start], jqsh.filter.Filter):
+            raise SyntaxError('Could not parse token list: ' + repr(tokens[start:len(tokens) - tail]))
     
     def raise_for_filter(the_filter):
         if filter_is_allowed(the_filter):
@@ -204,12 +335,12 @@ def parse(tokens, *, line_numbers=False, allowed_filters={'default': True}, cont
             raise jqsh.filter.NotAllowed('disallowed filter: ' + str(the_filter))
     
     if isinstance(tokens, str):
-        tokens = list(tokenize(tokens))
-    tokens = [token for token in tokens if isinstance(token, jqsh.filter.Filter) or token.type is not TokenType.comment]
+        tokens = tokenize(tokens)
+    tokens = [token for token in tokens if isinstance(token, jqsh.filter.Filter) or token.type is not TokenType.comment] # the only copy of the token list, parsed in place
     if not len(tokens):
         return raise_for_filter(jqsh.filter.Filter()) # token list is empty, return an empty filter
     for token in tokens:
-        if token.type is TokenType.illegal:
+        if isinstance(token, Token) and token.type is TokenType.illegal:
             raise illegal_token_exception(token, line_numbers=line_numbers)
     if isinstance(tokens[-1], Token) and tokens[-1].type is TokenType.trailing_whitespace:
         if len(tokens) == 1:
@@ -217,116 +348,50 @@ def parse(tokens, *, line_numbers=False, allowed_filters={'default': True}, cont
         else:
             tokens[-2].string += tokens[-1].string # merge the trailing whitespace into the second-to-last token
             tokens.pop() # remove the trailing_whitespace token
-    
-    # parenthesis-like filters
-    paren_balance = 0
-    paren_start = None
-    middle_keywords = []
-    for i, token in reversed(list(enumerate(tokens))): # iterating over the token list in reverse because we modify it in the process
-        if not isinstance(token, Token):
-            continue
-        elif token.type in matching_parens.values() or token == Token(TokenType.name, text='end'):
-            if paren_balance == 0:
-                paren_start = i
-                if token == Token(TokenType.name, text='end'):
-                    middle_keywords = []
-            paren_balance += 1
-        elif token.type in matching_parens.keys() or token.type is TokenType.name and token.text in keyword_parens.keys():
-            paren_balance -= 1
-            if paren_balance < 0:
-                raise Incomplete('too many opening parens of type ' + repr(token.text if token.type is TokenType.name else token.type))
-            elif paren_balance == 0:
-                if token.type is TokenType.name:
-                    middle_keywords = [index for index in middle_keywords if tokens[index].text in keyword_parens[token.text]]
-                    attributes = []
-                    last_index = paren_start
-                    for index in middle_keywords:
-                        attributes.append((tokens[index].text, tokens[index + 1:last_index]))
-                        last_index = index
-                    attributes.append((token.text, tokens[i + 1:last_index]))
-                    tokens[i:paren_start + 1] = [raise_for_filter(make_keyword_paren_filter(reversed(attributes)))]
-                else:
-                    if matching_parens[token.type] is tokens[paren_start].type:
-                        tokens[i:paren_start + 1] = [raise_for_filter(paren_filters[token.type](attribute=parse(tokens[i + 1:paren_start], line_numbers=line_numbers, allowed_filters=allowed_filters)))] # parse the inside of the parens
-                    else:
-                        raise SyntaxError('opening paren of type ' + repr(token.type) + ' does not match closing paren of type ' + repr(tokens[paren_start].type))
-                paren_start = None
-        elif paren_balance == 1 and token.type is TokenType.name:
-            middle_keywords.append(i)
-    if paren_balance != 0:
-        raise SyntaxError('mismatched parens')
-    
-    # atomic filters
-    for i, token in reversed(list(enumerate(tokens))):
-        if isinstance(token, Token) and token.type in atomic_tokens:
-            tokens[i] = raise_for_filter(atomic_tokens[token.type](token.text))
-    
-    # operators
-    for precedence_group in operators:
-        if precedence_group == 'variadic apply':
-            start = None
-            for i, token in reversed(list(enumerate(tokens))):
-                if isinstance(token, jqsh.filter.Filter):
-                    if start is None:
-                        start = i
-                else:
-                    if start is not None and start > i + 1:
-                        tokens[i + 1:start + 1] = [raise_for_filter(jqsh.filter.Apply(*tokens[i + 1:start + 1]))]
-                    start = None
-            if start is not None and start > 0:
-                tokens[:start + 1] = [raise_for_filter(jqsh.filter.Apply(*tokens[:start + 1]))]
-            continue
-        if not precedence_group.get('binary', True):
-            for i, token in reversed(list(enumerate(tokens))):
-                if isinstance(token, Token) and token.type in precedence_group:
-                    if len(tokens) == i + 1:
-                        raise SyntaxError('expected a filter after ' + repr(token) + ', nothing found')
-                    elif isinstance(tokens[i + 1], Token):
-                        raise SyntaxError('expected a filter after ' + repr(token) + ', found ' + repr(tokens[i + 1]) + ' instead')
-                    tokens[i:i + 2] = [raise_for_filter(precedence_group[token.type](attribute=tokens[i + 1]))]
-            continue
-        ltr = not precedence_group.get('rtl', False)
-        if ltr:
-            tokens.reverse()
-        left_operand = None
-        right_operand = None
-        has_previous_operand = False
-        has_next_operand = False
-        for i, token in reversed(list(enumerate(tokens))):
-            if isinstance(token, jqsh.filter.Filter) and has_next_operand:
-                tokens[i:i + (3 if has_previous_operand else 2)] = [precedence_group[tokens[i + 1].type](left=left_operand, right=right_operand)]
-                has_next_operand = False
-            elif isinstance(token, Token) and token.type in precedence_group:
-                left_operand, has_left_operand = (tokens[i - 1], True) if i > 0 and isinstance(tokens[i - 1], jqsh.filter.Filter) else (raise_for_filter(jqsh.filter.Filter()), False)
-                right_operand, has_right_operand = (tokens[i + 1], True) if i + 1 < len(tokens) and isinstance(tokens[i + 1], jqsh.filter.Filter) else (raise_for_filter(jqsh.filter.Filter()), False)
-                has_previous_operand = has_right_operand
-                has_next_operand = has_left_operand
-                if ltr:
-                    left_operand, right_operand = right_operand, left_operand
-                    has_left_operand, has_right_operand = has_right_operand, has_left_operand
-                if not has_next_operand:
-                    tokens[i:i + (2 if has_previous_operand else 1)] = [precedence_group[token.type](left=left_operand, right=right_operand)]
-            else:
-                has_next_operand = False
-        if ltr:
-            tokens.reverse()
-    
-    if len(tokens) == 1 and isinstance(tokens[0], jqsh.filter.Filter):
-        return tokens[0] # finished parsing
-    else:
-        raise SyntaxError('Could not parse token list: ' + repr(tokens))
+    parse_range(0, len(tokens))
+    return tokens[0] # finished parsing
 
 def parse_json(tokens, allow_extension_types=False):
     if isinstance(tokens, str):
         tokens = list(tokenize(tokens))
-    if len(tokens) == 0 or len(tokens) == 1 and isinstance(tokens[0], Token) and tokens[0].type is TokenType.trailing_whitespace:
+    stop = len(tokens)
+    if stop and isinstance(tokens[-1], Token) and tokens[-1].type is TokenType.trailing_whitespace:
+        stop -= 1
+    ret, token_index = parse_json_prefix(tokens, stop=stop, allow_extension_types=allow_extension_types)
+    if token_index < stop:
+        raise SyntaxError('Multiple top-level JSON values found')
+    return ret
+
+def parse_json_bytes(json_bytes):
+    """Yields the JSON values in a bytes-like object of UTF-8 text, such as a memory-mapped file. Each value is parsed as soon as its last token has been read."""
+    yield from parse_json_tokens(tokenize_json_bytes(json_bytes))
+
+def parse_json_file(json_file):
+    """Yields the JSON values in a binary file object. Regular files are memory-mapped and decoded in place instead of being read into memory. Other files, such as pipes, are decoded line by line with parse_json_lines, so values are yielded before the file ends."""
+    try:
+        file_stat = os.fstat(json_file.fileno())
+    except (AttributeError, OSError, ValueError): # not backed by a file descriptor
+        file_stat = None
+    if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+        yield from parse_json_lines(json_file)
+    elif file_stat.st_size > 0: # empty files cannot be mapped
+        with mmap.mmap(json_file.fileno(), 0, access=mmap.ACCESS_READ) as json_map, memoryview(json_map) as json_bytes:
+            yield from parse_json_bytes(json_bytes)
+
+def parse_json_lines(json_lines):
+    """Yields the JSON values in an iterable of UTF-8 encoded lines, such as a pipe opened in binary mode. JSON tokens cannot span lines, so each value is yielded as soon as the line containing its end has been read."""
+    yield from parse_json_tokens(token for line in json_lines for token in tokenize_json_bytes(line))
+
+def parse_json_prefix(tokens, start=0, stop=None, allow_extension_types=False):
+    """Parses the JSON value starting at tokens[start] without copying the token list. Returns the value and the index of the token after it."""
+    if stop is None:
+        stop = len(tokens)
+    if start >= stop:
         raise Incomplete('JSON is empty')
-    if isinstance(tokens[-1], Token) and tokens[-1].type is TokenType.trailing_whitespace:
-        tokens.pop()
     ret_path = []
     key = None
-    token_index = 0
-    while token_index < len(tokens):
+    token_index = start
+    while token_index < stop:
         token = tokens[token_index]
         if allow_extension_types and isinstance(token, jqsh.values.Value):
             ret_path = set_value_at_ret_path(ret_path, key, token)
@@ -350,7 +415,7 @@ def parse_json(tokens, allow_extension_types=False):
             array = jqsh.values.Array(terminated=False)
             ret_path = set_value_at_ret_path(ret_path, key, array)
             token_index += 1
-            if token_index >= len(tokens):
+            if token_index >= stop:
                 raise Incomplete('Unclosed JSON array at position ' + str(token_index))
             if tokens[token_index].type is TokenType.close_array: # empty array parsed
                 array.terminate()
@@ -362,7 +427,7 @@ def parse_json(tokens, allow_extension_types=False):
             obj = jqsh.values.Object(terminated=False)
             ret_path = set_value_at_ret_path(ret_path, key, obj)
             token_index += 1
-            if token_index >= len(tokens):
+            if token_index >= stop:
                 raise Incomplete('Unclosed JSON object at position ' + str(token_index))
             token = tokens[token_index]
             if token.type is TokenType.close_object: # empty object parsed
@@ -372,26 +437,26 @@ def parse_json(tokens, allow_extension_types=False):
                 ret_path.append(obj)
                 key = token.text
                 token_index += 1
-                if token_index >= len(tokens):
+                if token_index >= stop:
                     raise Incomplete('Unclosed JSON object at position ' + str(token_index))
                 elif tokens[token_index].type is not TokenType.colon:
                     raise illegal_token_exception(token, position=token_index, expected={TokenType.colon})
                 else:
                     token_index += 1
-                    if token_index >= len(tokens):
+                    if token_index >= stop:
                         raise Incomplete('Unclosed JSON object at position ' + str(token_index))
                     continue
             else:
                 raise illegal_token_exception(token, position=token_index, expected={TokenType.close_object, TokenType.string})
         elif token.type is TokenType.string:
-            ret_path = set_value_at_ret_path(ret_path, key, token.text)
+            ret_path = set_value_at_ret_path(ret_path, key, jqsh.values.String(token.text))
             token_index += 1
         else:
             raise illegal_token_exception(token, position=token_index, expected={TokenType.name, TokenType.number, TokenType.open_array, TokenType.open_object, TokenType.string, TokenType.trailing_whitespace})
         keep_closing = True
         while keep_closing and len(ret_path) > 1:
             if isinstance(ret_path[-1], jqsh.values.Object): # we are in an object, get the next key or close it
-                if token_index >= len(tokens):
+                if token_index >= stop:
                     raise Incomplete('Unclosed JSON object at position ' + str(token_index))
                 token = tokens[token_index]
                 if token.type is TokenType.close_object:
@@ -403,19 +468,19 @@ def parse_json(tokens, allow_extension_types=False):
                     token_index += 1
                 elif token.type is TokenType.comma:
                     token_index += 1
-                    if token_index >= len(tokens):
+                    if token_index >= stop:
                         raise Incomplete('Unclosed JSON object at position ' + str(token_index))
                     token = tokens[token_index]
                     if token.type is TokenType.string:
                         key = token.text
                         token_index += 1
-                        if token_index >= len(tokens):
+                        if token_index >= stop:
                             raise Incomplete('Unclosed JSON object at position ' + str(token_index))
                         elif tokens[token_index].type is not TokenType.colon:
                             raise illegal_token_exception(token, position=token_index, expected={TokenType.colon})
                         else:
                             token_index += 1
-                            if token_index >= len(tokens):
+                            if token_index >= stop:
                                 raise Incomplete('Unclosed JSON object at position ' + str(token_index))
                             keep_closing = False
                     else:
@@ -423,7 +488,7 @@ def parse_json(tokens, allow_extension_types=False):
                 else:
                     raise illegal_token_exception(token, position=token_index, expected={TokenType.close_object, TokenType.comma})
             else: # we are in an array, check if it continues
-                if token_index >= len(tokens):
+                if token_index >= stop:
                     raise Incomplete('Unclosed JSON array at position ' + str(token_index))
                 token = tokens[token_index]
                 if token.type is TokenType.close_array:
@@ -435,32 +500,45 @@ def parse_json(tokens, allow_extension_types=False):
                     token_index += 1
                 elif token.type is TokenType.comma:
                     token_index += 1
-                    if token_index >= len(tokens):
+                    if token_index >= stop:
                         raise Incomplete('Unclosed JSON array at position ' + str(token_index))
                     keep_closing = False
                 else:
                     raise illegal_token_exception(token, position=token_index, expected={TokenType.close_array, TokenType.comma})
-    if token_index < len(tokens):
-        raise SyntaxError('Multiple top-level JSON values found')
-    return ret_path[0]
+        if len(ret_path) == 1:
+            break # the top-level value is complete
+    return ret_path[0], token_index
 
 def parse_json_values(tokens):
     if isinstance(tokens, str):
         tokens = list(tokenize(tokens))
-    if len(tokens) and tokens[-1].type is TokenType.trailing_whitespace:
-        tokens = tokens[:-1]
-    prefix_length = 1
-    last_exception = None
-    while len(tokens):
-        if prefix_length > len(tokens):
-            raise last_exception
-        try:
-            yield parse_json(tokens[:prefix_length])
-            tokens = tokens[prefix_length:]
-            prefix_length = 1
-        except Incomplete as e:
-            last_exception = e
-            prefix_length += 1
+    elif isinstance(tokens, (bytes, bytearray, memoryview, mmap.mmap)):
+        yield from parse_json_bytes(tokens)
+        return
+    stop = len(tokens)
+    if stop and tokens[-1].type is TokenType.trailing_whitespace:
+        stop -= 1
+    token_index = 0
+    while token_index < stop:
+        value, token_index = parse_json_prefix(tokens, start=token_index, stop=stop)
+        yield value
+
+def parse_json_tokens(tokens):
+    """Yields the JSON values in an iterable of tokens, parsing each value as soon as its last token arrives."""
+    value_tokens = []
+    depth = 0
+    for token in tokens:
+        value_tokens.append(token)
+        if token.type in matching_parens:
+            depth += 1
+        elif token.type in matching_parens.values():
+            depth -= 1
+        if depth <= 0:
+            yield parse_json(value_tokens)
+            value_tokens = []
+            depth = 0
+    if len(value_tokens):
+        parse_json(value_tokens) # raises Incomplete
 
 def set_value_at_ret_path(ret_path, key, value):
     if len(ret_path):
@@ -473,135 +551,159 @@ def set_value_at_ret_path(ret_path, key, value):
         return [value]
 
 def tokenize(jqsh_string):
-    def shift(rest_string, line, column, amount=1):
-        for _ in range(amount):
-            removed_character = rest_string[0]
-            rest_string = rest_string[1:]
-            if removed_character == '\n':
-                line += 1
-                column = 0
-            else:
-                column += 1
-        return rest_string, line, column
+    def shift(position, line, column, amount=1):
+        removed_string = jqsh_string[position:position + amount]
+        newlines = removed_string.count('\n')
+        if newlines:
+            return position + len(removed_string), line + newlines, len(removed_string) - removed_string.rindex('\n') - 1
+        else:
+            return position + len(removed_string), line, column + len(removed_string)
     
-    rest_string = jqsh_string
-    if not isinstance(rest_string, str):
-        rest_string = rest_string.decode('utf-8')
+    if not isinstance(jqsh_string, str):
+        jqsh_string = jqsh_string.decode('utf-8')
+    position = 0 # index of the first character that has not been tokenized yet. The input is never sliced, only the token strings are
     whitespace_prefix = ''
-    if rest_string.startswith('\ufeff'):
-        whitespace_prefix += rest_string[0]
-        rest_string = rest_string[1:]
+    if jqsh_string.startswith('\ufeff'):
+        whitespace_prefix += jqsh_string[0]
+        position += 1
     line = 1
     column = 0
     parens_stack = []
-    while len(parens_stack) and parens_stack[-1] < 0 or len(rest_string):
-        if len(parens_stack) and parens_stack[-1] < 0 or rest_string[0] == '"':
+    while len(parens_stack) and parens_stack[-1] < 0 or position < len(jqsh_string):
+        if len(parens_stack) and parens_stack[-1] < 0 or jqsh_string[position] == '"':
             if len(parens_stack) and parens_stack[-1] < 0:
                 token_type = TokenType.string_end_incomplete
-                string_literal = ')'
+                string_literal = [')']
                 parens_stack.pop()
                 string_start_line = line
                 string_start_column = column - 1
             else:
-                rest_string, line, column = shift(rest_string, line, column)
+                position, line, column = shift(position, line, column)
                 token_type = TokenType.string_incomplete
-                string_literal = '"'
+                string_literal = ['"']
                 string_start_line = line
                 string_start_column = column
-            string_content = ''
-            while len(rest_string):
-                if rest_string[0] == '"':
+            string_content = []
+            while position < len(jqsh_string):
+                if jqsh_string[position] == '"':
                     token_type = {
                         TokenType.string_end_incomplete: TokenType.string_end,
                         TokenType.string_incomplete: TokenType.string
                     }[token_type]
-                    string_literal += '"'
-                    rest_string, line, column = shift(rest_string, line, column)
+                    string_literal.append('"')
+                    position, line, column = shift(position, line, column)
                     break
-                elif rest_string[0] == '\\':
-                    rest_string, line, column = shift(rest_string, line, column)
-                    if rest_string[0] in escapes:
-                        string_literal += '\\' + rest_string[0]
-                        string_content += escapes[rest_string[0]]
-                        rest_string, line, column = shift(rest_string, line, column)
-                    elif rest_string[0] == 'u':
+                elif jqsh_string[position] == '\\':
+                    position, line, column = shift(position, line, column)
+                    if jqsh_string[position:position + 1] in escapes:
+                        string_literal.append('\\' + jqsh_string[position])
+                        string_content.append(escapes[jqsh_string[position]])
+                        position, line, column = shift(position, line, column)
+                    elif jqsh_string[position:position + 1] == 'u':
                         try:
-                            escape_sequence = int(rest_string[1:5], 16)
-                        except (IndexError, ValueError):
-                            yield Token(token_type, token_string=whitespace_prefix + string_literal, text=string_content, line=string_start_line, column=string_start_column)
-                            yield Token(TokenType.illegal, token_string=whitespace_prefix + rest_string, text=rest_string, line=line, column=column)
+                            escape_sequence = int(jqsh_string[position + 1:position + 5], 16)
+                        except ValueError:
+                            yield Token(token_type, token_string=whitespace_prefix + ''.join(string_literal), text=''.join(string_content), line=string_start_line, column=string_start_column)
+                            yield Token(TokenType.illegal, token_string=whitespace_prefix + jqsh_string[position:], text=jqsh_string[position:], line=line, column=column)
                             return
                         else:
-                            string_literal += '\\' + rest_string[:5]
-                            string_content += chr(escape_sequence) #TODO check for UTF-16 surrogate characters
-                            rest_string, line, column = shift(rest_string, line, column, amount=5)
-                    elif rest_string[0] == '(':
-                        string_literal += '\\('
+                            string_literal.append('\\' + jqsh_string[position:position + 5])
+                            string_content.append(chr(escape_sequence)) #TODO check for UTF-16 surrogate characters
+                            position, line, column = shift(position, line, column, amount=5)
+                    elif jqsh_string[position:position + 1] == '(':
+                        string_literal.append('\\(')
                         parens_stack.append(0)
                         token_type = {
                             TokenType.string_end_incomplete: TokenType.string_middle,
                             TokenType.string_incomplete: TokenType.string_start
                         }[token_type]
-                        rest_string, line, column = shift(rest_string, line, column)
+                        position, line, column = shift(position, line, column)
                         break
                     else:
-                        yield Token(token_type, token_string=whitespace_prefix + string_literal, text=string_content, line=string_start_line, column=string_start_column)
-                        yield Token(TokenType.illegal, token_string=whitespace_prefix + '\\' + rest_string, text='\\' + rest_string, line=line, column=column)
+                        yield Token(token_type, token_string=whitespace_prefix + ''.join(string_literal), text=''.join(string_content), line=string_start_line, column=string_start_column)
+                        yield Token(TokenType.illegal, token_string=whitespace_prefix + '\\' + jqsh_string[position:], text='\\' + jqsh_string[position:], line=line, column=column)
                         return
                 else:
-                    string_literal += rest_string[0]
-                    string_content += rest_string[0]
-                    rest_string, line, column = shift(rest_string, line, column)
-            yield Token(token_type, token_string=whitespace_prefix + string_literal, text=string_content, line=string_start_line, column=string_start_column)
+                    characters = token_patterns['string'].match(jqsh_string, position).group()
+                    string_literal.append(characters)
+                    string_content.append(characters)
+                    position, line, column = shift(position, line, column, amount=len(characters))
+            yield Token(token_type, token_string=whitespace_prefix + ''.join(string_literal), text=''.join(string_content), line=string_start_line, column=string_start_column)
             whitespace_prefix = ''
-        elif rest_string[0] in string.whitespace:
-            whitespace_prefix += rest_string[0]
-            rest_string, line, column = shift(rest_string, line, column)
-        elif rest_string[0] == '#':
+        elif jqsh_string[position] in string.whitespace:
+            whitespace = token_patterns['whitespace'].match(jqsh_string, position).group()
+            whitespace_prefix += whitespace
+            position, line, column = shift(position, line, column, amount=len(whitespace))
+        elif jqsh_string[position] == '#':
             comment_start_line = line
             comment_start_column = column
-            rest_string, line, column = shift(rest_string, line, column)
-            comment = ''
-            while len(rest_string):
-                if rest_string[0] == '\n':
-                    break
-                comment += rest_string[0]
-                rest_string, line, column = shift(rest_string, line, column)
+            position, line, column = shift(position, line, column)
+            comment_end = jqsh_string.find('\n', position)
+            if comment_end == -1:
+                comment_end = len(jqsh_string)
+            comment = jqsh_string[position:comment_end]
+            position, line, column = shift(position, line, column, amount=len(comment))
             yield Token(TokenType.comment, token_string=whitespace_prefix + '#' + comment, text=comment, line=comment_start_line, column=comment_start_column)
             whitespace_prefix = ''
-        elif rest_string[0] in string.ascii_letters:
-            name_start_line = line
-            name_start_column = column
-            name = ''
-            while len(rest_string) and rest_string[0] in string.ascii_letters:
-                name += rest_string[0]
-                rest_string, line, column = shift(rest_string, line, column)
-            yield Token(TokenType.name, token_string=whitespace_prefix + name, text=name, line=name_start_line, column=name_start_column)
+        elif jqsh_string[position] in string.ascii_letters:
+            name = token_patterns['name'].match(jqsh_string, position).group()
+            yield Token(TokenType.name, token_string=whitespace_prefix + name, text=name, line=line, column=column)
             whitespace_prefix = ''
-        elif rest_string[0] in string.digits:
-            number_start_line = line
-            number_start_column = column
-            number = ''
-            while len(rest_string) and rest_string[0] in string.digits:
-                number += rest_string[0]
-                rest_string, line, column = shift(rest_string, line, column)
-            yield Token(TokenType.number, token_string=whitespace_prefix + number, text=number, line=number_start_line, column=number_start_column)
+            position, line, column = shift(position, line, column, amount=len(name))
+        elif jqsh_string[position] in string.digits:
+            number = token_patterns['number'].match(jqsh_string, position).group()
+            yield Token(TokenType.number, token_string=whitespace_prefix + number, text=number, line=line, column=column)
             whitespace_prefix = ''
-        elif any(rest_string.startswith(symbol) for symbol in symbols):
-            for symbol, token_type in sorted(symbols.items(), key=lambda pair: -len(pair[0])): # look at longer symbols first, so that a += is not mistakenly tokenized as a +
-                if rest_string.startswith(symbol):
+            position, line, column = shift(position, line, column, amount=len(number))
+        else:
+            for symbol, token_type in symbols_longest_first:
+                if jqsh_string.startswith(symbol, position):
                     if len(parens_stack):
                         if token_type is TokenType.open_paren:
                             parens_stack[-1] += 1
                         elif token_type is TokenType.close_paren:
                             parens_stack[-1] -= 1
                     if len(parens_stack) == 0 or parens_stack[-1] >= 0:
-                        yield Token(token_type, token_string=whitespace_prefix + rest_string[:len(symbol)], line=line, column=column)
+                        yield Token(token_type, token_string=whitespace_prefix + symbol, line=line, column=column)
                         whitespace_prefix = ''
-                    rest_string, line, column = shift(rest_string, line, column, amount=len(symbol))
+                    position, line, column = shift(position, line, column, amount=len(symbol))
                     break
-        else:
-            yield Token(TokenType.illegal, token_string=whitespace_prefix + rest_string, text=rest_string, line=line, column=column)
-            return
+            else:
+                yield Token(TokenType.illegal, token_string=whitespace_prefix + jqsh_string[position:], text=jqsh_string[position:], line=line, column=column)
+                return
     if len(whitespace_prefix):
         yield Token(TokenType.trailing_whitespace, token_string=whitespace_prefix)
+
+def tokenize_json_bytes(json_bytes):
+    """Yields the JSON tokens in a bytes-like object of UTF-8 text.
+    
+    Only string, number and name literals are decoded, and the tokens do not keep their source strings or line numbers.
+    """
+    def decode_escape(match):
+        if match.group(1) is not None:
+            return chr(int(match.group(1), 16))
+        return escapes[match.group(2)]
+    
+    position = 3 if json_bytes[:3] == b'\xef\xbb\xbf' else 0 # skip the byte order mark
+    while True:
+        match = token_patterns['json_bytes'].match(json_bytes, position)
+        position = match.end()
+        if match.lastgroup is None:
+            if position < len(json_bytes):
+                illegal_text = bytes(json_bytes[position:position + 4]).decode('utf-8', errors='replace')
+                yield Token(TokenType.illegal, text=illegal_text)
+            return
+        elif match.lastgroup == 'symbol':
+            yield Token(json_byte_symbols[json_bytes[position - 1]])
+        elif match.lastgroup == 'string':
+            try:
+                text = match.group('string').decode('utf-8')
+                if '\\' in text:
+                    text = token_patterns['json_escape'].sub(decode_escape, text)
+            except (KeyError, UnicodeDecodeError):
+                illegal_text = bytes(json_bytes[match.start('string') - 1:position]).decode('utf-8', errors='replace')
+                yield Token(TokenType.illegal, text=illegal_text)
+                return
+            yield Token(TokenType.string, text=text)
+        else:
+            yield Token(TokenType[match.lastgroup], text=match.group(match.lastgroup).decode('ascii'))
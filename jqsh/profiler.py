@@ -0,0 +1,58 @@
+import threading
+
+class NodeProfile:
+    """Statistics for one filter node, summed over all the times it ran."""
+    blocked_seconds = 0.0 # time spent waiting for values on the input channel
+    runs = 0 # number of filter threads that ran this node
+    threads = 0 # number of threads started on behalf of this node, including the filter threads of its children
+    values_in = 0 # number of values read from the input channel
+    values_out = 0 # number of values read from the output channel by the consumer
+    wall_seconds = 0.0 # time from starting to finishing the filter threads
+    
+    def __init__(self, profiler, the_filter):
+        self.profiler = profiler
+        self.filter = the_filter
+    
+    def add(self, **counts):
+        """Adds to the statistics named by the keyword arguments. Called from the threads of the filter."""
+        with self.profiler.lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+class Profiler:
+    """Collects a NodeProfile for each filter node run by a jqsh.filter.FilterThread started with this profiler, and for the nodes started from it.
+    
+    Nodes are identified by the filter object, so a node that runs several times, such as the body of reduce, gets one profile with the sums.
+    """
+    columns = ('wall_seconds', 'runs', 'values_in', 'values_out', 'threads', 'blocked_seconds')
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles = {} # id of the filter: NodeProfile, which keeps the filter alive so its id is not reused
+    
+    def node_profile(self, the_filter):
+        """Returns the NodeProfile for the filter node, creating it on first use."""
+        with self.lock:
+            if id(the_filter) not in self.profiles:
+                self.profiles[id(the_filter)] = NodeProfile(self, the_filter)
+            return self.profiles[id(the_filter)]
+    
+    def report_lines(self, the_filter, max_width=80):
+        """Yields the lines of a table with the statistics for each node in the tree of the filter, with the string representation of each node indented by its depth. Nodes that never ran are shown without statistics."""
+        import jqsh.filter
+        
+        yield ' '.join(['wall s', '  runs', '    in', '   out', 'thread', 'wait s', 'filter'])
+        nodes = [(the_filter, 0)]
+        while len(nodes):
+            node, depth = nodes.pop()
+            with self.lock:
+                profile = self.profiles.get(id(node))
+            if profile is None:
+                fields = [' ' * 6] * 5 + ['     -']
+            else:
+                fields = ['{:6.3f}'.format(profile.wall_seconds)] + ['{:6d}'.format(getattr(profile, column)) for column in self.columns[1:-1]] + ['{:6.3f}'.format(profile.blocked_seconds)]
+            node_string = '  ' * depth + (str(node) or repr(node))
+            if len(node_string) > max_width:
+                node_string = node_string[:max_width - 3] + '...'
+            yield ' '.join(fields + [node_string])
+            nodes += reversed([(child, depth + 1) for child in node.children() if child.__class__ != jqsh.filter.Filter]) # empty filters are shared, so their statistics would be misleading
@@ -0,0 +1,54 @@
+import jqsh.channel
+import json
+import os
+import threading
+import time
+
+class Tracer:
+    """Records what the threads of filters do, in the Trace Event Format read by chrome://tracing and Perfetto.
+    
+    Each thread started by a traced filter is shown as a track named after its filter node. The track has the thread's lifetime, channel push, pop, split and terminate events, and waits for the namespaces and context of channels. Pops are shown with the time spent waiting for a value. Channels are identified by the channel argument of the events.
+    """
+    def __init__(self):
+        jqsh.channel.tracing = True
+        self.events = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.start_time = time.perf_counter()
+        self.thread_ids = {} # thread: small number used as tid in the events, since thread idents are reused
+    
+    def complete(self, name, category, start_time, **args):
+        """Records an event in the current thread that started at start_time, a time.perf_counter value, and ends now."""
+        end_time = time.perf_counter()
+        self.record({'args': args, 'cat': category, 'dur': (end_time - start_time) * 1000000, 'name': name, 'ph': 'X', 'ts': self.timestamp(start_time)})
+    
+    def dump(self, trace_file):
+        """Writes the recorded events to the file as JSON."""
+        with self.lock:
+            events = list(self.events)
+        json.dump({'displayTimeUnit': 'ms', 'traceEvents': events}, trace_file)
+    
+    def instant(self, name, category, **args):
+        """Records an event without duration in the current thread."""
+        self.record({'args': args, 'cat': category, 'name': name, 'ph': 'i', 's': 't', 'ts': self.timestamp(time.perf_counter())})
+    
+    def record(self, event):
+        thread = threading.current_thread()
+        with self.lock:
+            if thread not in self.thread_ids:
+                self.thread_ids[thread] = len(self.thread_ids) + 1
+                self.events.append({'args': {'name': thread_name(thread)}, 'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': self.thread_ids[thread]})
+            event['pid'] = self.pid
+            event['tid'] = self.thread_ids[thread]
+            self.events.append(event)
+    
+    def timestamp(self, perf_counter):
+        """Converts a time.perf_counter value to microseconds since the tracer was created."""
+        return (perf_counter - self.start_time) * 1000000
+
+def thread_name(thread):
+    """Returns the name of the thread followed by its filter node, if any."""
+    the_filter = getattr(thread, 'filter', None)
+    if the_filter is None:
+        return thread.name
+    return thread.name + ': ' + (str(the_filter) or repr(the_filter))
@@ -6,11 +6,14 @@ import decimal
 import functools
 import itertools
 import jqsh.channel
-import more_itertools
 import numbers
 import operator
-import sys
-import traceback
+import re
+
+def dump(value, output_file, compact=False, sort_keys=True):
+    """Writes the representation of a value to a text file object, one chunk at a time."""
+    for chunk in serialize(value, compact=compact, sort_keys=sort_keys):
+        output_file.write(chunk)
 
 def from_native(python_object):
     """Constructs a jqsh value from the passed Python object. The Python object may be anything the json module can work with."""
@@ -36,6 +39,69 @@ def from_native(python_object):
     else:
         return Array(python_object)
 
+@functools.lru_cache(maxsize=16)
+def highlighter(terminal):
+    """Returns the SyntaxHighlighter for a blessings terminal, creating it on first use so its styled strings are only computed once."""
+    return SyntaxHighlighter(terminal)
+
+def indent_lines(lines, suffix=''):
+    """Yields the lines indented by two spaces, with suffix appended to the last line. Lines are yielded one behind the input, so this works on lines that are still being generated."""
+    previous_line = None
+    for line in lines:
+        if previous_line is not None:
+            yield ' ' * 2 + previous_line
+        previous_line = line
+    if previous_line is not None:
+        yield ' ' * 2 + previous_line + suffix
+
+def serialize(value, compact=False, sort_keys=True):
+    """Yields the representation of a value as a series of strings, without recursing into arrays and objects.
+    
+    By default, the output is the same as str(value). With compact=True, no spaces are added after separators. With sort_keys=False, object keys are kept in insertion order.
+    """
+    import jqsh.filter
+    
+    item_separator, key_separator = (',', ':') if compact else (', ', ': ')
+    stack = [] # (remaining values, separators to put before them, closing bracket) for each array or object being serialized
+    while True:
+        if isinstance(value, Array):
+            yield '['
+            stack.append((iter(value), itertools.chain([''], itertools.repeat(item_separator)), ']'))
+        elif isinstance(value, Object):
+            yield '{'
+            items = sorted(value.items()) if sort_keys else value.items()
+            stack.append((itertools.chain.from_iterable(items), itertools.chain([''], itertools.cycle([key_separator, item_separator])), '}'))
+        elif isinstance(value, String):
+            yield jqsh.filter.StringLiteral.representation(value.value)
+        else:
+            yield str(value)
+        while len(stack):
+            remaining_values, separators, closing_bracket = stack[-1]
+            try:
+                value = next(remaining_values)
+            except StopIteration:
+                stack.pop()
+                yield closing_bracket
+            else:
+                yield next(separators)
+                break
+        else:
+            return
+
+def serialize_bytes(value, compact=False, sort_keys=True, chunk_size=65536):
+    """Yields the UTF-8 encoded representation of a value in chunks of roughly chunk_size bytes, so that large values can be written to binary files and pipes without building the whole representation."""
+    chunks = []
+    buffered_size = 0
+    for chunk in serialize(value, compact=compact, sort_keys=sort_keys):
+        chunks.append(chunk)
+        buffered_size += len(chunk)
+        if buffered_size >= chunk_size:
+            yield ''.join(chunks).encode('utf-8')
+            chunks = []
+            buffered_size = 0
+    if len(chunks):
+        yield ''.join(chunks).encode('utf-8')
+
 @functools.total_ordering
 class Value(abc.ABC):
     @abc.abstractmethod
@@ -53,8 +119,12 @@ class Value(abc.ABC):
     def __repr__(self):
         return 'jqsh.values.' + self.__class__.__name__ + '(' + repr(self.value) + ')'
     
-    def print_to_terminal(self, terminal, output_file):
-        for line in self.syntax_highlight_lines(terminal):
+    def print_to_terminal(self, terminal, output_file, sort_keys=True):
+        if not terminal.does_styling and self.serializable():
+            dump(self, output_file, sort_keys=sort_keys)
+            print(file=output_file, flush=True)
+            return
+        for line in self.syntax_highlight_lines(terminal, sort_keys=sort_keys):
             print(line, file=output_file, flush=True)
     
     @abc.abstractmethod
@@ -63,7 +133,7 @@ class Value(abc.ABC):
         return False
     
     @abc.abstractmethod
-    def syntax_highlight_lines(self, terminal):
+    def syntax_highlight_lines(self, terminal, sort_keys=True):
         return
         yield
 
@@ -95,7 +165,7 @@ class JQSHException(Value):
     def serializable(self):
         return False
     
-    def syntax_highlight_lines(self, terminal):
+    def syntax_highlight_lines(self, terminal, sort_keys=True):
         if not terminal.does_styling:
             yield str(self)
             return
@@ -145,11 +215,11 @@ class Null(Value):
     def serializable(self):
         return True
     
-    def syntax_highlight_lines(self, terminal):
+    def syntax_highlight_lines(self, terminal, sort_keys=True):
         if not terminal.does_styling:
             yield str(self)
             return
-        yield terminal.bold(terminal.color(28)('null'))
+        yield highlighter(terminal).null
 
 class Boolean(Value):
     def __bool__(self):
@@ -186,11 +256,11 @@ class Boolean(Value):
     def serializable(self):
         return True
     
-    def syntax_highlight_lines(self, terminal):
+    def syntax_highlight_lines(self, terminal, sort_keys=True):
         if not terminal.does_styling:
             yield str(self)
             return
-        yield terminal.bold(terminal.color(28)('true' if self.value else 'false'))
+        yield highlighter(terminal).true if self.value else highlighter(terminal).false
 
 class Number(Value, decimal.Decimal):
     def __bool__(self):
@@ -221,11 +291,11 @@ class Number(Value, decimal.Decimal):
     def serializable(self):
         return True
     
-    def syntax_highlight_lines(self, terminal):
+    def syntax_highlight_lines(self, terminal, sort_keys=True):
         if not terminal.does_styling:
             yield str(self)
             return
-        yield terminal.color(32)(str(self))
+        yield highlighter(terminal).number(str(self))
     
     @property
     def value(self):
@@ -283,8 +353,8 @@ class String(Value, jqsh.channel.Channel, collections.abc.Sequence):
         for index in itertools.count():
             try:
                 yield self[index]
-            except IndexError as e:
-                raise StopIteration('Reached end of jqsh string') from e
+            except IndexError:
+                return # reached end of jqsh string
     
     def __len__(self):
         while not self.terminated:
@@ -314,15 +384,23 @@ class String(Value, jqsh.channel.Channel, collections.abc.Sequence):
         
         return jqsh.filter.StringLiteral.representation(self.value)
     
-    def print_to_terminal(self, terminal, output_file):
-        if terminal.does_styling:
-            print(terminal.color(9)('"'), end='', flush=True, file=output_file)
-            for character in self:
-                print(terminal.color(202 if jqsh.filter.StringLiteral.escape(character).startswith('\\') else 1)(jqsh.filter.StringLiteral.escape(character)), end='', flush=True, file=output_file)
-            print(terminal.color(9)('"'), flush=True, file=output_file)
-        else:
-            for line in self.syntax_highlight_lines(terminal):
-                print(line, file=output_file, flush=True)
+    def print_to_terminal(self, terminal, output_file, sort_keys=True):
+        if not terminal.does_styling:
+            super().print_to_terminal(terminal, output_file, sort_keys=sort_keys)
+            return
+        syntax = highlighter(terminal)
+        if self.input_terminated:
+            print(syntax.string(self.value), file=output_file, flush=True)
+            return
+        # the string is still being generated, so show each run of characters as soon as no more are available
+        print(syntax.quote, end='', file=output_file, flush=True)
+        characters = []
+        for character in self:
+            characters.append(character)
+            if self.value_queue.empty():
+                print(syntax.string_contents(''.join(characters)), end='', file=output_file, flush=True)
+                characters = []
+        print(syntax.string_contents(''.join(characters)) + syntax.quote, file=output_file, flush=True)
     
     def push(self, value):
         error_message = 'String channel only accepts valid Unicode strings'
@@ -343,13 +421,11 @@ class String(Value, jqsh.channel.Channel, collections.abc.Sequence):
     def store_value(self, value):
         self.value_store += value
     
-    def syntax_highlight_lines(self, terminal):
-        import jqsh.filter
-        
+    def syntax_highlight_lines(self, terminal, sort_keys=True):
         if not terminal.does_styling:
             yield str(self)
             return
-        yield terminal.color(9)('"') + ''.join(terminal.color(202 if jqsh.filter.StringLiteral.escape(character).startswith('\\') else 1)(jqsh.filter.StringLiteral.escape(character)) for character in self.value) + terminal.color(9)('"')
+        yield highlighter(terminal).string(self.value)
     
     @property
     def value(self):
@@ -411,8 +487,8 @@ class Array(Value, jqsh.channel.Channel, collections.abc.Sequence):
         for index in itertools.count():
             try:
                 yield self[index]
-            except IndexError as e:
-                raise StopIteration('Reached end of jqsh array') from e
+            except IndexError:
+                return # reached end of jqsh array
     
     def __len__(self):
         while not self.terminated:
@@ -437,7 +513,7 @@ class Array(Value, jqsh.channel.Channel, collections.abc.Sequence):
             return True
     
     def __str__(self):
-        return '[' + ', '.join(str(item) for item in self) + ']'
+        return ''.join(serialize(self))
     
     def serializable(self):
         return all(serializable(item) for item in self)
@@ -445,34 +521,23 @@ class Array(Value, jqsh.channel.Channel, collections.abc.Sequence):
     def store_value(self, value):
         self.value_store.append(value)
     
-    def syntax_highlight_lines(self, terminal):
+    def syntax_highlight_lines(self, terminal, sort_keys=True):
         if not terminal.does_styling:
             yield str(self)
             return
-        has_items = False
-        iter_self = more_itertools.peekable(self)
-        for item in iter_self:
-            if not has_items:
-                yield terminal.bold(terminal.color(15)('['))
-            try:
-                iter_self.peek()
-            except StopIteration:
-                for line in item.syntax_highlight_lines(terminal):
-                    yield ' ' * 2 + line
+        syntax = highlighter(terminal)
+        previous_item = None
+        for item in self:
+            if previous_item is None:
+                yield syntax.open_array
             else:
-                iter_item = more_itertools.peekable(item.syntax_highlight_lines(terminal))
-                for line in iter_item:
-                    try:
-                        iter_item.peek()
-                    except StopIteration:
-                        yield ' ' * 2 + line + terminal.color(15)(',')
-                    else:
-                        yield ' ' * 2 + line
-            has_items = True
-        if has_items:
-            yield terminal.bold(terminal.color(15)(']'))
+                yield from indent_lines(previous_item.syntax_highlight_lines(terminal, sort_keys=sort_keys), suffix=syntax.comma)
+            previous_item = item
+        if previous_item is None:
+            yield syntax.empty_array
         else:
-            yield terminal.bold(terminal.color(15)('[]'))
+            yield from indent_lines(previous_item.syntax_highlight_lines(terminal, sort_keys=sort_keys))
+            yield syntax.close_array
     
     @property
     def value(self):
@@ -536,7 +601,7 @@ class Object(Value, jqsh.channel.Channel, collections.abc.Mapping):
             return True
     
     def __str__(self):
-        return '{' + ', '.join(str(key) + ': ' + str(item) for key, item in sorted(self.items())) + '}'
+        return ''.join(serialize(self))
     
     def items(self):
         return ObjectItemsView(self)
@@ -560,54 +625,22 @@ class Object(Value, jqsh.channel.Channel, collections.abc.Mapping):
         key, value = value
         self.value_store[key] = value
     
-    def syntax_highlight_lines(self, terminal):
+    def syntax_highlight_lines(self, terminal, sort_keys=True):
         if not terminal.does_styling:
             yield str(self)
             return
-        has_items = False
-        iter_self = more_itertools.peekable(sorted(list(self.keys())))
-        for item in iter_self:
-            if not has_items:
-                yield terminal.bold(terminal.color(15)('{'))
-            iter_key = more_itertools.peekable(item.syntax_highlight_lines(terminal))
-            for line in iter_key:
-                try:
-                    iter_key.peek()
-                except StopIteration:
-                    last_key_line = line
-                else:
-                    yield ' ' * 2 + line
-            try:
-                iter_self.peek()
-            except StopIteration:
-                for line in self[item].syntax_highlight_lines(terminal):
-                    if last_key_line is None:
-                        yield ' ' * 2 + line
-                    else:
-                        yield ' ' * 2 + last_key_line + terminal.color(15)(': ') + line
-                        last_key_line = None
-            else:
-                iter_item = more_itertools.peekable(self[item].syntax_highlight_lines(terminal))
-                for line in iter_item:
-                    try:
-                        iter_item.peek()
-                    except StopIteration:
-                        if last_key_line is None:
-                            yield ' ' * 2 + line + terminal.color(15)(',')
-                        else:
-                            yield ' ' * 2 + last_key_line + terminal.color(15)(': ') + line + terminal.color(15)(',')
-                            last_key_line = None
-                    else:
-                        if last_key_line is None:
-                            yield ' ' * 2 + line
-                        else:
-                            yield ' ' * 2 + last_key_line + terminal.color(15)(': ') + line
-                            last_key_line = None
-            has_items = True
-        if has_items:
-            yield terminal.bold(terminal.color(15)('}'))
-        else:
-            yield terminal.bold(terminal.color(15)('{}'))
+        syntax = highlighter(terminal)
+        keys = sorted(list(self.keys())) if sort_keys else list(self.keys())
+        if len(keys) == 0:
+            yield syntax.empty_object
+            return
+        yield syntax.open_object
+        for index, key in enumerate(keys):
+            key_lines = list(key.syntax_highlight_lines(terminal, sort_keys=sort_keys))
+            value_lines = self[key].syntax_highlight_lines(terminal, sort_keys=sort_keys)
+            key_lines[-1] += syntax.colon + next(value_lines)
+            yield from indent_lines(itertools.chain(key_lines, value_lines), suffix=syntax.comma if index < len(keys) - 1 else '')
+        yield syntax.close_object
     
     @property
     def value(self):
@@ -652,3 +685,53 @@ class ObjectItemsView(ObjectView, collections.abc.ItemsView):
             with contextlib.suppress(StopIteration):
                 self._mapping.pop()
         yield from self._mapping.value_store.items()
+
+class SyntaxHighlighter:
+    """Renders syntax-highlighted parts of values for a blessings terminal.
+    
+    The styled punctuation and keywords are computed once, escape sequences are cached per character, and each run of plain or escaped characters in a string is coloured with a single terminal call.
+    """
+    string_runs = re.compile('[ !#-\\[\\]-~]+|[^ !#-\\[\\]-~]+')
+    
+    def __init__(self, terminal):
+        self.terminal = terminal
+        self.escapes = {}
+        self.escaped_characters = terminal.color(202)
+        self.number = terminal.color(32)
+        self.plain_characters = terminal.color(1)
+        self.close_array = terminal.bold(terminal.color(15)(']'))
+        self.close_object = terminal.bold(terminal.color(15)('}'))
+        self.colon = terminal.color(15)(': ')
+        self.comma = terminal.color(15)(',')
+        self.empty_array = terminal.bold(terminal.color(15)('[]'))
+        self.empty_object = terminal.bold(terminal.color(15)('{}'))
+        self.false = terminal.bold(terminal.color(28)('false'))
+        self.null = terminal.bold(terminal.color(28)('null'))
+        self.open_array = terminal.bold(terminal.color(15)('['))
+        self.open_object = terminal.bold(terminal.color(15)('{'))
+        self.quote = terminal.color(9)('"')
+        self.true = terminal.bold(terminal.color(28)('true'))
+    
+    def escape(self, character):
+        """Returns the escape sequence for a character, computing it only the first time the character is seen."""
+        import jqsh.filter
+        
+        try:
+            return self.escapes[character]
+        except KeyError:
+            escape_sequence = self.escapes[character] = jqsh.filter.StringLiteral.escape(character)
+            return escape_sequence
+    
+    def string(self, text):
+        """Returns a string literal for the text, with quotes."""
+        return self.quote + self.string_contents(text) + self.quote
+    
+    def string_contents(self, text):
+        """Returns the contents of a string literal for the text, without quotes."""
+        ret = []
+        for run in self.string_runs.findall(text):
+            if run[0] in '"\\' or not ' ' <= run[0] <= '~':
+                ret.append(self.escaped_characters(''.join(self.escape(character) for character in run)))
+            else:
+                ret.append(self.plain_characters(run))
+        return ''.join(ret)
@@ -1,11 +1,343 @@
 #!/usr/bin/env python3
 
+import blessings
 import collections
+import contextlib
 import decimal
+import io
+import jqsh.bench
+import jqsh.channel
+import jqsh.cli
+import jqsh.client
+import jqsh.context
+import jqsh.filter
+import jqsh.functions
+import jqsh.memo
+import jqsh.parser
+import jqsh.profiler
+import jqsh.tracer
 import jqsh.values
+import json
+import os
+import queue
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
 
 class JQSHTests(unittest.TestCase):
+    def test_coprocess_pool(self):
+        pool = jqsh.filter.CoprocessPool(2)
+        command_line = (sys.executable, '-c', 'import os, sys\nfor line in sys.stdin:\n    print(line.strip(), os.getpid(), flush=True)\n    print(flush=True)')
+        outputs = [[value.value for value in pool.run(command_line, jqsh.values.from_native([i, 'a']))] for i in range(4)]
+        pool.close()
+        self.assertEqual([output[0] for output in outputs], [[i, 'a'] for i in range(4)])
+        self.assertLessEqual(len({output[1] for output in outputs}), 2)
+        context = jqsh.context.FilterContext()
+        context.coprocesses = jqsh.filter.CoprocessPool(1)
+        the_filter = jqsh.parser.parse('!{} "-c" {}'.format(json.dumps(sys.executable), json.dumps('import os, sys\nfor line in sys.stdin:\n    print(os.getpid(), flush=True)\n    print(flush=True)')))
+        pids = [value.value for _ in range(2) for value in the_filter.start(jqsh.cli.input_channel(jqsh.parser.parse_json_values('1 2'), context=context))]
+        context.coprocesses.close()
+        self.assertEqual(len(pids), 4)
+        self.assertEqual(len(set(pids)), 1) # commands with arguments use the pool too
+    
+    def test_bench(self):
+        results = jqsh.bench.run_benchmarks(['builtins'], repeat=1)
+        self.assertEqual(sorted(results['benchmarks']['builtins']), ['fibonacci_seconds', 'nth_seconds', 'range_seconds', 'reduce_seconds'])
+        self.assertEqual(jqsh.bench.run_filter('. * 2', jqsh.parser.parse_json_values('1 2')), '2\n4\n')
+        old_results = {'benchmarks': {'builtins': {'nth_seconds': 2.0, 'range_seconds': 'n/a'}, 'removed': {'seconds': 1.0}}}
+        new_results = {'benchmarks': {'builtins': {'nth_seconds': 0.5, 'range_seconds': 0.5}}}
+        self.assertEqual(list(jqsh.bench.compare(old_results, new_results)), ['builtins.nth_seconds: 2.000000s -> 0.500000s (4.00x)']) # only times in both results are compared
+    
+    def test_channel_registry(self):
+        self.assertNotIn(jqsh.channel.Channel(), jqsh.channel.registry.live_channels()) # not registered unless enabled
+        jqsh.channel.registry.enabled = True
+        try:
+            chan = jqsh.channel.Channel(1, 2)
+        finally:
+            jqsh.channel.registry.enabled = False
+        self.assertIn(chan, jqsh.channel.registry.unterminated_channels())
+        self.assertGreaterEqual(jqsh.channel.registry.metrics()['buffered_values'], 2)
+        chan.terminate()
+        self.assertNotIn(chan, jqsh.channel.registry.unterminated_channels())
+    
+    def test_command_output(self):
+        input_channel = jqsh.channel.Channel(empty_namespaces=True)
+        output_channel = jqsh.parser.parse('!"cat"').start(input_channel)
+        input_channel.push('x')
+        self.assertEqual(output_channel.pop(timeout=5), 'x') # before the input has ended
+        for _ in range(1000):
+            input_channel.push('y' * 100) # more than a pipe buffer holds
+        input_channel.terminate()
+        self.assertEqual([value.value for value in output_channel], ['y' * 100] * 1000)
+    
+    def test_connect(self):
+        with tempfile.TemporaryDirectory() as directory, tempfile.TemporaryFile() as input_file, tempfile.TemporaryFile() as output_file:
+            socket_path = directory + '/jqsh.sock'
+            threading.Thread(target=jqsh.cli.serve, args=(socket_path,), daemon=True).start()
+            while not os.path.exists(socket_path):
+                time.sleep(0.01)
+            input_file.write(b'{"b": 1, "a": 2}\n[3]')
+            input_file.seek(0)
+            jqsh.client.connect(socket_path, '.', input_files=[input_file], output_file=output_file, compact=True)
+            output_file.seek(0)
+            self.assertEqual(output_file.read(), b'{"a":2,"b":1}\n[3]\n')
+            with self.assertRaises(SyntaxError):
+                jqsh.client.connect(socket_path, '((', output_file=output_file)
+    
+    def test_decode_json_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = []
+            for file_index in range(3):
+                paths.append(directory + '/' + str(file_index) + '.json')
+                with open(paths[-1], 'w') as json_file:
+                    json_file.write(' '.join('[{}, {}]'.format(file_index, i) for i in range(2500)))
+            values = [value.value for value in jqsh.cli.decode_json_files(paths)]
+            self.assertEqual(values, [[file_index, i] for file_index in range(3) for i in range(2500)])
+            values = [value.value for value in jqsh.cli.decode_json_files(paths, interleave=True)]
+            self.assertEqual(sorted(values), [[file_index, i] for file_index in range(3) for i in range(2500)])
+            with open(paths[1], 'w') as json_file:
+                json_file.write('[1, ')
+            for interleave in (False, True):
+                with self.assertRaisesRegex(SyntaxError, '1.json'):
+                    list(jqsh.cli.decode_json_files(paths, interleave=interleave))
+    
+    def test_explain(self):
+        self.assertTrue(jqsh.parser.parse('. * 2 | ."a"').explain()['parallel'])
+        self.assertFalse(jqsh.parser.parse('. | [.]').explain()['parallel'])
+        the_filter = jqsh.parser.parse('reduce 0 (. + 1)')
+        self.assertEqual(the_filter.explain()['per_value'], (the_filter.attributes[2],))
+        lines = list(jqsh.cli.explain_lines(the_filter))
+        self.assertTrue(lines[-1].endswith('cannot be run with --jobs'))
+        self.assertEqual(lines[2].split(), ['-', '-', 'reduce'])
+    
+    def test_input_channel(self):
+        def failing_values(exception):
+            yield jqsh.values.Number(1)
+            raise exception
+        
+        for exception, name in ((OSError('read failed'), 'input'), (UnicodeDecodeError('utf-8', b'\xff', 0, 1, 'invalid start byte'), 'inputSyntax'), (RuntimeError('bug'), 'internal')):
+            output = list(jqsh.cli.input_channel(failing_values(exception)))
+            self.assertEqual(output[0], 1)
+            self.assertEqual(output[1].name, name)
+            self.assertEqual(len(output), 2) # the channel is terminated after the exception
+    
+    def test_linked_builtins(self):
+        the_filter = jqsh.parser.parse('each (. * 2)')
+        self.assertIs(the_filter.builtin, jqsh.functions.get_builtin('each', num_args=1))
+        self.assertEqual(the_filter.explain()['splits'], 0)
+        self.assertEqual([value.value for value in jqsh.parser.parse('range = 5; range').start(jqsh.cli.input_channel(jqsh.parser.parse_json_values('3')))], [5]) # local variables shadow builtins
+        self.assertEqual([value.name for value in jqsh.parser.parse('. | nth').start()], ['numArgs']) # fused, with the same exception as unfused
+    
+    def test_lookup_path(self):
+        the_filter = jqsh.parser.parse('."a"."b".0')
+        self.assertEqual([key.value for key in the_filter.path], ['a', 'b', 0])
+        self.assertEqual(the_filter.explain()['splits'], 0)
+        output = list(the_filter.start(jqsh.cli.input_channel(jqsh.parser.parse_json_values('{"a": {"b": [1, 2]}} {"a": {"b": {}}}'))))
+        self.assertEqual(output[0].value, 1)
+        self.assertEqual(output[1].name, 'key')
+    
+    def test_memo(self):
+        self.assertFalse(jqsh.parser.parse('each (argv 0)').pure())
+        context = jqsh.context.FilterContext()
+        context.memo = jqsh.memo.Memo(1)
+        the_filter = jqsh.parser.parse('each ([. * 2] | .0)')
+        self.assertEqual([value.value for value in the_filter.start(jqsh.cli.input_channel(jqsh.parser.parse_json_values('1 1 2 1'), context=context))], [2, 2, 4, 2])
+        self.assertEqual((context.memo.hits, context.memo.misses), (1, 3))
+        context.memo = jqsh.memo.Memo()
+        the_filter = jqsh.parser.parse('. | each (. * 2)') # fused into the pipe
+        self.assertEqual([value.value for value in the_filter.start(jqsh.cli.input_channel(jqsh.parser.parse_json_values('1 1'), context=context))], [2, 2])
+        self.assertEqual((context.memo.hits, context.memo.misses), (1, 1))
+        output = jqsh.parser.parse('each (.)').start(jqsh.cli.input_channel(jqsh.parser.parse_json_values('{"a": 1, "b": 2} {"b": 2, "a": 1}'), context=context))
+        self.assertEqual([''.join(jqsh.values.serialize(value, compact=True, sort_keys=False)) for value in output], ['{"a":1,"b":2}', '{"b":2,"a":1}'])
+    
+    def test_namespace(self):
+        parent = {'a': 1, 'b': 2}
+        namespace = jqsh.channel.Namespace({'b': 3}, parent=jqsh.channel.Namespace({'c': 4}, parent=parent))
+        self.assertEqual(dict(namespace), {'a': 1, 'b': 3, 'c': 4})
+        self.assertEqual(parent, {'a': 1, 'b': 2})
+        for i in range(100):
+            namespace = jqsh.channel.Namespace({'b': i}, parent=jqsh.channel.Namespace({'x' + str(i): i}, parent=namespace)) # reassigning b does not keep its old values
+        self.assertLessEqual(namespace.depth, jqsh.channel.Namespace.max_depth)
+        self.assertEqual(len([value for name, value in namespace.items() if name == 'b']), 1)
+        self.assertEqual((namespace['a'], namespace['b'], namespace['c'], namespace['x0']), (1, 99, 4, 0))
+        buffer = jqsh.channel.ReplayBuffer(jqsh.channel.Channel(1, 2, terminated=True))
+        self.assertEqual(list(buffer), [1, 2])
+        self.assertEqual(list(buffer), [1, 2])
+        self.assertEqual([value.value for value in jqsh.parser.parse('x = (1, 2); y = x; x, y').start()], [1, 2, 1, 2])
+    
+    def test_output_pairs(self):
+        self.assertEqual([value.value for value in jqsh.parser.parse('(1, 2) * (3, 4, 5, 6, 7)').start()], [3, 8, 5, 12, 7])
+        input_channel = jqsh.channel.Channel(1, empty_namespaces=True)
+        output_channel = jqsh.parser.parse('. + 1').start(input_channel)
+        self.assertEqual(output_channel.pop(timeout=5), 2) # before the input has ended
+        input_channel.push(2)
+        input_channel.terminate()
+        self.assertEqual([value.value for value in output_channel], [3])
+    
+    def test_output_writer(self):
+        class FakeStream:
+            def __init__(self):
+                self.writes = []
+            
+            def flush(self):
+                pass
+            
+            def write(self, data):
+                self.writes.append(data)
+        
+        def push_slowly():
+            time.sleep(0.5)
+            writes_before_push.extend(stream.writes)
+            channel.push(2)
+            channel.terminate()
+        
+        stream = FakeStream()
+        writer = jqsh.cli.OutputWriter(stream, buffer_size=10, flush_interval=60)
+        writer.write(jqsh.values.Number(1))
+        self.assertEqual(stream.writes, []) # buffered
+        writer.write(jqsh.values.String('abcdefgh'))
+        self.assertEqual(stream.writes, ['1\n"abcdefgh"']) # written once buffer_size characters are buffered
+        writer.flush()
+        self.assertEqual(stream.writes[1:], ['\n'])
+        stream = FakeStream()
+        channel = jqsh.channel.Channel(1)
+        writes_before_push = []
+        threading.Thread(target=push_slowly).start()
+        jqsh.cli.OutputWriter(stream, flush_interval=0.1).write_channel(channel)
+        self.assertEqual(writes_before_push, ['1\n']) # flushed while waiting for the next value
+        self.assertEqual(stream.writes, ['1\n', '2\n'])
+    
+    def test_parse_json_file(self):
+        json_string = '\ufeff[1, "\\u00e9\\n\u00e9"]\n{"a": {"b": []}} null'
+        with tempfile.TemporaryFile() as json_file:
+            json_file.write(json_string.encode('utf-8'))
+            json_file.flush()
+            json_file.seek(0)
+            self.assertEqual([value.value for value in jqsh.parser.parse_json_file(json_file)], [value.value for value in jqsh.parser.parse_json_values(json_string)])
+            json_file.seek(0)
+            self.assertEqual([value.value for value in jqsh.parser.parse_json_lines(json_file)], [value.value for value in jqsh.parser.parse_json_values(json_string)])
+        read_fd, write_fd = os.pipe()
+        with open(read_fd, 'rb') as read_file, open(write_fd, 'wb', buffering=0) as write_file:
+            values = jqsh.parser.parse_json_file(read_file)
+            write_file.write(b'[1]\n{"a"')
+            self.assertEqual(next(values).value, [1]) # before the pipe is closed
+            write_file.write(b': 2}')
+            write_file.close()
+            self.assertEqual([value.value for value in values], [[('a', 2)]])
+        with self.assertRaises(jqsh.parser.Incomplete):
+            list(jqsh.parser.parse_json_values(b'[1, '))
+    
+    def test_pipe_fusion(self):
+        the_filter = jqsh.parser.parse('."a" | . * 2 | [. | range]')
+        self.assertEqual(the_filter.explain()['fused'], (the_filter.left_operand,))
+        self.assertEqual([value.value for value in the_filter.start(jqsh.cli.input_channel(jqsh.parser.parse_json_values('{"a": 1} {"a": 2}')))], [[0, 1, 0, 1, 2, 3]])
+        output = list(jqsh.parser.parse('."a" | ."b"').start(jqsh.cli.input_channel(jqsh.parser.parse_json_values('{"a": {"b": 1}} {"a": 2} {"a": {"b": 3}}'))))
+        self.assertEqual(output[0].value, 1)
+        self.assertIsInstance(output[1], jqsh.values.JQSHException)
+        self.assertEqual(len(output), 2)
+        self.assertEqual([value.value for value in jqsh.parser.parse('"ab" | explode * 2').start()], [194, 196]) # explode yields Python ints
+    
+    def test_print_outputs(self):
+        filters = [jqsh.parser.parse('. * 2'), jqsh.parser.parse('"x"')]
+        def filter_threads():
+            input_channels = jqsh.cli.input_channel(jqsh.parser.parse_json_values('1 2')) / 2
+            return [jqsh.filter.FilterThread(the_filter, input_channel=input_channel) for the_filter, input_channel in zip(filters, input_channels)]
+        
+        output_files = [io.StringIO(), io.StringIO()]
+        jqsh.cli.print_outputs(filter_threads(), output_files=output_files)
+        self.assertEqual([output_file.getvalue() for output_file in output_files], ['2\n4\n', '"x"\n'])
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            jqsh.cli.print_outputs(filter_threads(), compact=True)
+        self.assertEqual(sorted(stdout.getvalue().splitlines()), ['[0,2]', '[0,4]', '[1,"x"]'])
+    
+    def test_profiler(self):
+        the_filter = jqsh.parser.parse('. | [. * 2]')
+        profiler = jqsh.profiler.Profiler()
+        filter_thread = jqsh.filter.FilterThread(the_filter, input_channel=jqsh.cli.input_channel(jqsh.parser.parse_json_values('1 2 3')), profiler=profiler)
+        jqsh.cli.print_output(filter_thread, output_file=io.StringIO())
+        filter_thread.join()
+        profile = profiler.node_profile(the_filter)
+        self.assertEqual((profile.runs, profile.values_in, profile.values_out), (1, 3, 1)) # the array collects all values
+        self.assertEqual(profiler.node_profile(the_filter.right_operand.attribute).values_in, 3)
+        report = list(profiler.report_lines(the_filter))
+        self.assertEqual([line[42:] for line in report[1:]], ['. | [. * 2]', '  .', '  [. * 2]', '    . * 2', '      .', '      2'])
+        the_filter = jqsh.parser.parse('. * 2 | . + 1') # fusable, but fused operands would not be profiled
+        filter_thread = jqsh.filter.FilterThread(the_filter, input_channel=jqsh.cli.input_channel(jqsh.parser.parse_json_values('1 2')), profiler=profiler)
+        jqsh.cli.print_output(filter_thread, output_file=io.StringIO())
+        filter_thread.join()
+        profile = profiler.node_profile(the_filter.right_operand)
+        self.assertEqual((profile.runs, profile.values_in, profile.values_out), (1, 2, 2))
+    
+    def test_reduce(self):
+        def run(filter_string, input_string):
+            return [value.value for value in jqsh.parser.parse(filter_string).start(jqsh.cli.input_channel(jqsh.parser.parse_json_values(input_string)))]
+        
+        self.assertEqual(run('range | reduce 0 (. + 1)', '1000'), [1000])
+        self.assertEqual(run('range | reduce 0 ([. + 1] | .0)', '20'), [20])
+        self.assertEqual(run('range | for 0 (. * 2 + 1)', '3'), [1, 3, 7])
+    
+    def test_run_jobs(self):
+        def make_queue():
+            finished_queues.append(queue_class())
+            return finished_queues[-1]
+        
+        queue_class = queue.Queue
+        for ordered in (True, False):
+            finished_queues = []
+            output_file = io.StringIO()
+            with unittest.mock.patch('queue.Queue', side_effect=make_queue):
+                jqsh.cli.run_jobs(jqsh.parser.parse('. * 2'), [io.BytesIO(b''.join(b'%d\n' % i for i in range(1000)))], 3, ordered=ordered, chunk_size=100, output_file=output_file, compact=True)
+            outputs = [int(line) for line in output_file.getvalue().splitlines()]
+            self.assertEqual(outputs if ordered else sorted(outputs), [2 * i for i in range(1000)])
+            self.assertEqual(finished_queues[0].qsize(), 0) # ordered runs do not keep outputs in the queue
+    
+    def test_tracer(self):
+        tracer = jqsh.tracer.Tracer()
+        filter_thread = jqsh.filter.FilterThread(jqsh.parser.parse('[. * 2]'), input_channel=jqsh.cli.input_channel(jqsh.parser.parse_json_values('1 2')), tracer=tracer)
+        jqsh.cli.print_output(filter_thread, output_file=io.StringIO())
+        filter_thread.join()
+        trace_file = io.StringIO()
+        tracer.dump(trace_file)
+        trace_file.seek(0)
+        events = json.load(trace_file)['traceEvents']
+        thread_names = {event['tid']: event['args']['name'] for event in events if event['ph'] == 'M'}
+        self.assertIn('jqsh FilterThread: . * 2', thread_names.values())
+        self.assertEqual(len([event for event in events if event['name'] == 'push' and thread_names[event['tid']] == 'jqsh FilterThread: . * 2']), 2)
+    
+    def test_serialize(self):
+        value = next(jqsh.parser.parse_json_values('{"b": [1, "x\\ty", []], "a": {"d": null, "c": true}}'))
+        self.assertEqual(''.join(jqsh.values.serialize(value)), str(value))
+        self.assertEqual(''.join(jqsh.values.serialize(value, compact=True)), '{"a":{"c":true,"d":null},"b":[1,"x\\ty",[]]}')
+        self.assertEqual(''.join(jqsh.values.serialize(value, compact=True, sort_keys=False)), '{"b":[1,"x\\ty",[]],"a":{"d":null,"c":true}}')
+        deep_value = next(jqsh.parser.parse_json_values('[' * 5000 + ']' * 5000))
+        self.assertEqual(str(deep_value), '[' * 5000 + ']' * 5000)
+        self.assertEqual(b''.join(jqsh.values.serialize_bytes(deep_value, chunk_size=100)), b'[' * 5000 + b']' * 5000)
+    
+    def test_startup_imports(self):
+        importtime_output = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'jqsh', '-c', '.'], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+        imported_modules = {line.split('|')[-1].strip() for line in importtime_output.splitlines()}
+        self.assertIn('jqsh.cli', imported_modules)
+        self.assertEqual(imported_modules & {'blessings', 'glob', 'json', 'more_itertools', 'multiprocessing', 'pathlib', 'subprocess', 'traceback'}, set()) # only imported where they are used
+    
+    def test_syntax_highlight_lines(self):
+        terminal = blessings.Terminal(kind='xterm-256color', force_styling=True)
+        value = next(jqsh.parser.parse_json_values('{"b": ["x\\ty\\u00e9z", {}], "a": null}'))
+        lines = [re.sub('\x1b\\[[0-9;]*m|\x1b\\(B', '', line) for line in value.syntax_highlight_lines(terminal)]
+        self.assertEqual(lines, ['{', '  "a": null,', '  "b": [', '    "x\\ty\\u00e9z",', '    {}', '  ]', '}'])
+        self.assertEqual(jqsh.values.highlighter(terminal).string_contents('ab\\\n'), terminal.color(1)('ab') + terminal.color(202)('\\\\\\n'))
+    
+    def test_tokenize(self):
+        jqsh_string = '\ufeff# comment\n$fib = def (range | reduce (0, 1) (nth 1, nth 0 + nth 1)); "a\\(1 + (2))b\\u00e9" \n'
+        tokens = list(jqsh.parser.tokenize(jqsh_string))
+        self.assertEqual(''.join(token.string for token in tokens), jqsh_string)
+        self.assertEqual([(token.line, token.column) for token in tokens[:4]], [(1, 0), (2, 0), (2, 1), (2, 5)])
+        self.assertEqual([value.value for value in jqsh.parser.parse_json_values('1 [true, null] {"a": "b"} ')], [1, [True, None], [('a', 'b')]])
+    
     def test_value_abcs(self):
         with self.assertRaises(TypeError):
             jqsh.values.Value()